@@ -81,8 +81,10 @@ class Evaluator(object):
         model_opt = checkpoint['opt']
 
 
-        posSize= checkpoint['autoencoder']['nmt.decoder.positional_encoder.pos_emb'].size(0)
-        self.models[0].decoder.renew_buffer(posSize)
+        # newer checkpoints do not store the positional encoding table
+        if 'nmt.decoder.positional_encoder.pos_emb' in checkpoint['autoencoder']:
+            posSize= checkpoint['autoencoder']['nmt.decoder.positional_encoder.pos_emb'].size(0)
+            self.models[0].decoder.renew_buffer(posSize)
 
 
         # Build model from the saved option
@@ -25,6 +25,7 @@ def build_model(opt, dicts):
     onmt.constants.version = 1.0
     onmt.constants.attention_out = opt.attention_out
     onmt.constants.residual_type = opt.residual_type
+    onmt.constants.bf16 = opt.bf16
 
     if not opt.fusion:
         model = build_tm_model(opt, dicts)
@@ -13,6 +13,7 @@ EOS_WORD = '</s>'
 checkpointing = 0
 static = False
 residual_type = 'regular'
+bf16 = False
 max_position_length = 8192
 torch_version = float(torch.__version__[:3])
 double_precision = False
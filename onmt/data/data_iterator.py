@@ -104,6 +104,10 @@ class EpochBatchIterating(object):
         """Returns whether the most recent epoch iterator has been exhausted"""
         raise NotImplementedError
 
+    def set_epoch(self, epoch):
+        """Start the next call of *next_epoch_itr* at *epoch* (which also seeds the shuffling)."""
+        raise NotImplementedError
+
     @property
     def iterations_in_epoch(self) -> int:
         """The number of consumed batches in the current epoch."""
@@ -125,10 +129,27 @@ dataset (~torch.utils.data.Dataset)
 """
 
 
+class EpochBatchSampler(object):
+    """
+    Batch sampler whose batches can be replaced between epochs,
+    so that one DataLoader (and its worker processes) can be reused for all epochs
+    """
+
+    def __init__(self):
+        self.batches = []
+
+    def __iter__(self):
+        return iter(self.batches)
+
+    def __len__(self):
+        return len(self.batches)
+
+
 class DataIterator(EpochBatchIterating):
 
     def __init__(self, dataset, collate_fn, batch_sampler, seed=1, num_workers=0,
-                 epoch=1, buffer_size=0, timeout=0, num_shards=1, shard_id=0, fill_value=None):
+                 epoch=1, buffer_size=0, timeout=0, num_shards=1, shard_id=0, fill_value=None,
+                 persistent_workers=False):
         """
         :param dataset:
         :param collate_fn:
@@ -140,6 +161,7 @@ class DataIterator(EpochBatchIterating):
         :param timeout:
         :param shard_id: equivalent with rank
         :param num_shards: equivalent with world size
+        :param persistent_workers: keep the worker processes alive between epochs (only with num_workers > 0)
         """
         assert isinstance(dataset, torch.utils.data.Dataset)
 
@@ -161,6 +183,10 @@ class DataIterator(EpochBatchIterating):
         self._support_prefetch = False
         self.fill_value = fill_value
 
+        self.persistent_workers = persistent_workers and num_workers > 0
+        self._batch_sampler = EpochBatchSampler()
+        self._data_loader = None
+
     def __len__(self):
         # number of minibatches, or ???
         return len(self.frozen_batches)
@@ -198,6 +224,11 @@ class DataIterator(EpochBatchIterating):
     def end_of_epoch(self) -> bool:
         return not self._cur_epoch_itr.has_next()
 
+    def set_epoch(self, epoch):
+        self.epoch = max(epoch, 1)
+        self._cur_epoch_itr = None
+        self._next_epoch_itr = None
+
     @property
     def iterations_in_epoch(self):
         """ The number of consumed batches in the current epoch"""
@@ -270,14 +301,29 @@ class DataIterator(EpochBatchIterating):
             os.environ['PYTHONWARNINGS'] = 'ignore:semaphore_tracker:UserWarning'
 
         # Create data loader
-        itr = torch.utils.data.DataLoader(
-            self.dataset,
-            collate_fn=self.collate_fn,
-            batch_sampler=batches[offset:],
-            num_workers=self.num_workers,
-            pin_memory=pin_memory,
-            timeout=self.timeout,
-        )
+        if self.persistent_workers:
+            # the workers only receive batch indices, so the sampler can be refilled for every epoch
+            self._batch_sampler.batches = batches[offset:]
+            if self._data_loader is None or self._data_loader.pin_memory != pin_memory:
+                self._data_loader = torch.utils.data.DataLoader(
+                    self.dataset,
+                    collate_fn=self.collate_fn,
+                    batch_sampler=self._batch_sampler,
+                    num_workers=self.num_workers,
+                    pin_memory=pin_memory,
+                    timeout=self.timeout,
+                    persistent_workers=True,
+                )
+            itr = self._data_loader
+        else:
+            itr = torch.utils.data.DataLoader(
+                self.dataset,
+                collate_fn=self.collate_fn,
+                batch_sampler=batches[offset:],
+                num_workers=self.num_workers,
+                pin_memory=pin_memory,
+                timeout=self.timeout,
+            )
 
         # Wrap with a BufferedIterator if needed
         if self.buffer_size > 0:
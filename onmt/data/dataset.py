@@ -115,6 +115,8 @@ def collect_fn(src_data, tgt_data,
         tensors['target'] = target_full
         tensors['target_input'] = target_full[:-1]
         tensors['target_output'] = target_full[1:]
+        # computed once here (in the loader workers) and reused by the trainer for the model, loss and statistics
+        tensors['tgt_mask'] = tensors['target_output'].ne(onmt.constants.PAD)
         if target_pos is not None:
             tensors['target_pos'] = target_pos.t().contiguous()[:-1]
         tgt_size = sum([len(x) - 1 for x in tgt_data])
@@ -158,17 +160,21 @@ class Batch(object):
         self.has_target = True if self.tensors['target'] is not None else False
         self.vocab_mask = tensors['vocab_mask']
 
+        if self.has_target and self.tensors['tgt_mask'] is None and self.tensors['target_output'] is not None:
+            self.tensors['tgt_mask'] = self.tensors['target_output'].ne(onmt.constants.PAD)
+
     def get(self, name):
         if name in self.tensors:
             return self.tensors[name]
         else:
             return None
 
-    def cuda(self, fp16=False, device=None):
+    def cuda(self, fp16=False, device=None, non_blocking=False):
         """
         Send the minibatch data into GPU.
         :param device: default = None (default CUDA device)
         :param fp16:
+        :param non_blocking: asynchronous copy (only if the tensors are in pinned memory)
         :return: None
         """
         for key, tensor in self.tensors.items():
@@ -176,15 +182,26 @@ class Batch(object):
                 for k in tensor:
                     if isinstance(k, torch.Tensor):
                         v = tensor[k]
-                        tensor[k] = v.cuda(device=device)
+                        tensor[k] = v.cuda(device=device, non_blocking=non_blocking)
             elif tensor is not None:
                 if isinstance(tensor, torch.Tensor):
                     if tensor.type() == "torch.FloatTensor" and fp16:
                         self.tensors[key] = tensor.half()
-                    self.tensors[key] = self.tensors[key].cuda(device=device)
+                    self.tensors[key] = self.tensors[key].cuda(device=device, non_blocking=non_blocking)
             else:
                 continue
 
+    def record_stream(self, stream):
+        """
+        Mark the (GPU) tensors as used by another stream than the one that copied them,
+        so that the caching allocator does not reuse their memory too early
+        :param stream: torch.cuda.Stream
+        :return: None
+        """
+        for key, tensor in self.tensors.items():
+            if isinstance(tensor, torch.Tensor) and tensor.is_cuda:
+                tensor.record_stream(stream)
+
     def switchout(self, swrate, src_vocab_size, tgt_vocab_size):
         # Switch out function ... currently works with only source text data
         # if self.src_type == 'text':
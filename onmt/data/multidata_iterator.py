@@ -136,14 +136,15 @@ class MultiDataIterator(EpochBatchIterating):
     # each dataset = dataiterator > generate 1 epoch iterator
     # this class gen
     def __init__(self, datasets, seed=1., num_workers=0, epoch=1, buffer_size=0,
-                 timeout=0, round_robin=False, num_shards=1, shard_id=0):
+                 timeout=0, round_robin=False, num_shards=1, shard_id=0, persistent_workers=False):
 
         self.datasets = datasets
         self.data_iterators = list()
         for dataset in datasets:
             self.data_iterators.append(DataIterator(dataset, dataset.collater, dataset.batches, seed=seed,
                                                     num_workers=num_workers, epoch=epoch, buffer_size=buffer_size,
-                                                    timeout=timeout, num_shards=num_shards, shard_id=shard_id))
+                                                    timeout=timeout, num_shards=num_shards, shard_id=shard_id,
+                                                    persistent_workers=persistent_workers))
 
         self.shuffle = True
         self._cur_epoch_itr = None
@@ -170,6 +171,11 @@ class MultiDataIterator(EpochBatchIterating):
     def end_of_epoch(self) -> bool:
         return not self._cur_epoch_itr.has_next()
 
+    def set_epoch(self, epoch):
+        self.epoch = max(epoch, 1)
+        self._cur_epoch_itr = None
+        self._next_epoch_itr = None
+
     def state_dict(self):
         """Returns a dictionary containing a whole state of the iterator."""
         return {
@@ -4,27 +4,58 @@ import onmt
 from onmt.models.transformers import TransformerEncoder, TransformerDecoder, Transformer, MixedEncoder
 from onmt.models.relative_transformer import RelativeTransformerEncoder, RelativeTransformerDecoder, \
             RelativeTransformer
-from onmt.models.transformer_layers import PositionalEncoding
+from onmt.models.transformer_layers import PositionalEncoding, EncoderLayer, DecoderLayer
+from onmt.models.transformer_layers import FusedLayerNorm as _FusedLayerNorm
 from onmt.models.relative_transformer import SinusoidalPositionalEmbedding, RelativeTransformer
+from onmt.models.speech_recognizer.relative_transformer import SpeechTransformerEncoder, SpeechTransformerDecoder
+from onmt.models.speech_recognizer.conformer import ConformerEncoder, Conformer
+from onmt.models.speech_recognizer.lstm import SpeechLSTMDecoder, SpeechLSTMEncoder, SpeechLSTMSeq2Seq
+from onmt.models.multilingual_translator.relative_transformer import \
+    RelativeTransformerEncoder as MultilingualRelativeTransformerEncoder, \
+    RelativeTransformerDecoder as MultilingualRelativeTransformerDecoder
+from onmt.models.distance_transformer import DistanceTransformerEncoder, DistanceTransformerDecoder
+from onmt.models.universal_transformer import UniversalTransformerDecoder, UniversalTransformerEncoder
+from onmt.models.relative_universal_transformer import \
+    RelativeUniversalTransformerEncoder, RelativeUniversalTransformerDecoder
+from onmt.models.relative_unified_transformer import RelativeUnifiedTransformer
+from onmt.models.memory_transformer import MemoryTransformer
+from onmt.models.transformer_xl import TransformerXL
 from onmt.modules.copy_generator import CopyGenerator
+from onmt.modules.nce.nce_linear import NCELinear
+from onmt.modules.nce.nce_utils import build_unigram_noise
 from options import backward_compatible
+from collections import defaultdict
 import math
+import numpy as np
+
+# None if apex or its fused_layer_norm_cuda extension is missing
+_FUSED_LN_AVAILABLE = _FusedLayerNorm is not None
 
 init = torch.nn.init
 
 MAX_LEN = onmt.constants.max_position_length  # This should be the longest sentence from the dataset
 
+# embeddings smaller than this (vocab_size x model_size) are cheap enough to keep dense gradients
+SPARSE_EMBEDDING_THRESHOLD = 10000000
+
 
 def build_model(opt, dicts):
     # adding missing options if the opt was built before. (for loading old models)
     opt = backward_compatible(opt)
 
+    # allow TF32 tensor cores for fp32 matmuls and convolutions (Ampere or newer GPUs)
+    if hasattr(torch.backends.cuda, 'matmul') and hasattr(torch.backends.cuda.matmul, 'allow_tf32'):
+        torch.backends.cuda.matmul.allow_tf32 = True
+    if hasattr(torch.backends.cudnn, 'allow_tf32'):
+        torch.backends.cudnn.allow_tf32 = True
+
     onmt.constants.layer_norm = opt.layer_norm
     onmt.constants.weight_norm = opt.weight_norm
     onmt.constants.activation_layer = opt.activation_layer
     onmt.constants.version = 1.0
     onmt.constants.attention_out = opt.attention_out
     onmt.constants.residual_type = opt.residual_type
+    onmt.constants.bf16 = opt.bf16
     onmt.constants.fused_ffn = opt.fused_ffn
     opt.nce = opt.nce_noise > 0
 
@@ -46,6 +77,22 @@ def build_model(opt, dicts):
     return model
 
 
+def use_sparse_embedding(opt, vocab_size):
+    """
+    Sparse gradients only touch the embedding rows used in the batch, but they are not supported
+    by the fp16 (apex) path, weight decay, optimizers other than sgd or an output layer sharing the embedding weights
+    """
+    if not opt.sparse_embedding or vocab_size * opt.model_size < SPARSE_EMBEDDING_THRESHOLD:
+        return False
+
+    if opt.optim != 'sgd' or opt.weight_decay > 0 or opt.fp16 or opt.tie_weights:
+        print("[WARNING] Sparse embedding requires sgd without weight_decay, fp16 and tie_weights "
+              "(optim: %s, weight_decay: %g). Using dense gradients." % (opt.optim, opt.weight_decay))
+        return False
+
+    return True
+
+
 def build_tm_model(opt, dicts):
     # BUILD POSITIONAL ENCODING
     if opt.time == 'positional_encoding':
@@ -67,8 +114,6 @@ def build_tm_model(opt, dicts):
         generators = [CopyGenerator(opt.model_size, dicts['tgt'].size(),
                                     fix_norm=opt.fix_norm_output_embedding)]
     elif opt.nce_noise > 0:
-        from onmt.modules.nce.nce_linear import NCELinear
-        from onmt.modules.nce.nce_utils import build_unigram_noise
         noise_distribution = build_unigram_noise(torch.FloatTensor(list(dicts['tgt'].frequencies.values())))
 
         generator = NCELinear(opt.model_size, dicts['tgt'].size(), fix_norm=opt.fix_norm_output_embedding,
@@ -82,7 +127,8 @@ def build_tm_model(opt, dicts):
     if 'src' in dicts:
         embedding_src = nn.Embedding(dicts['src'].size(),
                                      opt.model_size,
-                                     padding_idx=onmt.constants.PAD)
+                                     padding_idx=onmt.constants.PAD,
+                                     sparse=use_sparse_embedding(opt, dicts['src'].size()))
     else:
         embedding_src = None
 
@@ -92,7 +138,8 @@ def build_tm_model(opt, dicts):
     else:
         embedding_tgt = nn.Embedding(dicts['tgt'].size(),
                                      opt.model_size,
-                                     padding_idx=onmt.constants.PAD)
+                                     padding_idx=onmt.constants.PAD,
+                                     sparse=use_sparse_embedding(opt, dicts['tgt'].size()))
 
     if opt.use_language_embedding:
         print("* Create language embeddings with %d languages" % len(dicts['langs']))
@@ -103,192 +150,295 @@ def build_tm_model(opt, dicts):
     if opt.ctc_loss != 0:
         generators.append(onmt.modules.base_seq2seq.Generator(opt.model_size, dicts['tgt'].size() + 1))
 
-    if opt.model in ['conformer', 'speech_transformer', 'hybrid_transformer']:
-        onmt.constants.init_value = opt.param_init
-        from onmt.models.speech_recognizer.relative_transformer import \
-            SpeechTransformerEncoder, SpeechTransformerDecoder
+    if opt.model not in _MODEL_BUILDERS:
+        raise NotImplementedError
 
-        if opt.model == 'conformer':
-            from onmt.models.speech_recognizer.conformer import ConformerEncoder, Conformer
-            from onmt.models.speech_recognizer.lstm import SpeechLSTMDecoder
-            opt.cnn_downsampling = True  # force this bool to have masking at decoder to be corrected
-            encoder = ConformerEncoder(opt, None, None, 'audio')
+    model = _MODEL_BUILDERS[opt.model](opt, dicts, embedding_src, embedding_tgt,
+                                       positional_encoder, language_embeddings, generators)
 
-            decoder = SpeechLSTMDecoder(opt, embedding_tgt, language_embeddings=language_embeddings)
+    if opt.tie_weights:
+        print("* Joining the weights of decoder input and output embeddings")
+        model.tie_weights()
 
-            model = Conformer(encoder, decoder, nn.ModuleList(generators), ctc=opt.ctc_loss > 0.0)
-        elif opt.model == 'hybrid_transformer':
-            from onmt.models.speech_recognizer.lstm import SpeechLSTMDecoder, SpeechLSTMEncoder, SpeechLSTMSeq2Seq
-            encoder = SpeechTransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
+        # the output projection has to alias the embedding Parameter itself (shared with the source side
+        # under join_embedding), otherwise a second V x D copy is allocated and updated separately
+        generator_weight = model.generator[0].linear.weight
+        assert any(m.weight is generator_weight for m in model.modules() if isinstance(m, nn.Embedding)), \
+            "tie_weights has to share the Parameter of the target embedding with the output layer"
 
-            decoder = SpeechLSTMDecoder(opt, embedding_tgt, language_embeddings=language_embeddings)
+    if opt.torch_compile:
+        compile_layers(model)
 
-            model = SpeechLSTMSeq2Seq(encoder, decoder, nn.ModuleList(generators), ctc=opt.ctc_loss > 0.0)
-        else:
-            encoder = SpeechTransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
+    return model
 
-            decoder = SpeechTransformerDecoder(opt, embedding_tgt, positional_encoder,
-                                           language_embeddings=language_embeddings)
-            model = RelativeTransformer(encoder, decoder, nn.ModuleList(generators),
-                                        None, None, mirror=opt.mirror_loss, ctc=opt.ctc_loss > 0.0)
 
-        # If we use the multilingual model and weights are partitioned:
-        if opt.multilingual_partitioned_weights:
+def compile_layers(model):
+    """
+    Compile every encoder/decoder layer in place with torch.compile
+    The layers are compiled one by one (rather than wrapping the whole model) so that the
+    Python loop over the stack, incremental decoding and checkpointing keep working and the
+    state dict keys stay the same
+    """
+    if not hasattr(nn.Module, 'compile'):
+        print("[INFO] torch.compile is not available in this PyTorch version. Layers are not compiled.")
+        return
+
+    n_compiled = 0
+    for module in model.modules():
+        if isinstance(module, (EncoderLayer, DecoderLayer)):
+            # sequence length and batch size change from batch to batch
+            module.compile(dynamic=True)
+            n_compiled += 1
 
-            # this is basically the language embeddings
-            factor_embeddings = nn.Embedding(len(dicts['langs']), opt.mpw_factor_size)
+    print("* Compiled %d Transformer layers with torch.compile" % n_compiled)
 
-            encoder.factor_embeddings = factor_embeddings
-            decoder.factor_embeddings = factor_embeddings
 
-    elif opt.model in ["LSTM", 'lstm']:
-        # print("LSTM")
-        onmt.constants.init_value = opt.param_init
-        from onmt.models.speech_recognizer.lstm import SpeechLSTMDecoder, SpeechLSTMEncoder, SpeechLSTMSeq2Seq
+# The model builders below share the signature
+# (opt, dicts, embedding_src, embedding_tgt, positional_encoder, language_embeddings, generators)
+# and are dispatched on opt.model through _MODEL_BUILDERS
 
-        encoder = SpeechLSTMEncoder(opt, None, opt.encoder_type)
+def _build_speech_model(opt, dicts, embedding_src, embedding_tgt, positional_encoder, language_embeddings,
+                        generators):
+    onmt.constants.init_value = opt.param_init
+
+    if opt.model == 'conformer':
+        opt.cnn_downsampling = True  # force this bool to have masking at decoder to be corrected
+        encoder = ConformerEncoder(opt, None, None, 'audio')
 
         decoder = SpeechLSTMDecoder(opt, embedding_tgt, language_embeddings=language_embeddings)
 
-        model = SpeechLSTMSeq2Seq(encoder, decoder, nn.ModuleList(generators), ctc=opt.ctc_loss > 0.0)
+        model = Conformer(encoder, decoder, nn.ModuleList(generators), ctc=opt.ctc_loss > 0.0)
+    elif opt.model == 'hybrid_transformer':
+        encoder = SpeechTransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
 
-    elif opt.model in ['multilingual_translator', 'translator']:
-        onmt.constants.init_value = opt.param_init
-        from onmt.models.multilingual_translator.relative_transformer import \
-            RelativeTransformerEncoder, RelativeTransformerDecoder
+        decoder = SpeechLSTMDecoder(opt, embedding_tgt, language_embeddings=language_embeddings)
 
-        encoder = RelativeTransformerEncoder(opt, embedding_src, None,
-                                             opt.encoder_type, language_embeddings=language_embeddings)
-        decoder = RelativeTransformerDecoder(opt, embedding_tgt, None, language_embeddings=language_embeddings)
+        model = SpeechLSTMSeq2Seq(encoder, decoder, nn.ModuleList(generators), ctc=opt.ctc_loss > 0.0)
+    else:
+        encoder = SpeechTransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
 
+        decoder = SpeechTransformerDecoder(opt, embedding_tgt, positional_encoder,
+                                           language_embeddings=language_embeddings)
         model = RelativeTransformer(encoder, decoder, nn.ModuleList(generators),
-                                    None, None, mirror=opt.mirror_loss)
-
-    elif opt.model in ['transformer', 'stochastic_transformer']:
-        onmt.constants.init_value = opt.param_init
-
-        if opt.encoder_type == "text":
-            encoder = TransformerEncoder(opt, embedding_src, positional_encoder,
-                                         opt.encoder_type, language_embeddings=language_embeddings)
-        elif opt.encoder_type == "audio":
-            encoder = TransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
-        elif opt.encoder_type == "mix":
-            text_encoder = TransformerEncoder(opt, embedding_src, positional_encoder,
-                                              "text", language_embeddings=language_embeddings)
-            audio_encoder = TransformerEncoder(opt, None, positional_encoder, "audio")
-            encoder = MixedEncoder(text_encoder, audio_encoder)
-        else:
-            print("Unknown encoder type:", opt.encoder_type)
-            exit(-1)
+                                    None, None, mirror=opt.mirror_loss, ctc=opt.ctc_loss > 0.0)
 
-        decoder = TransformerDecoder(opt, embedding_tgt, positional_encoder, language_embeddings=language_embeddings)
+    # If we use the multilingual model and weights are partitioned:
+    if opt.multilingual_partitioned_weights:
 
-        model = Transformer(encoder, decoder, nn.ModuleList(generators), mirror=opt.mirror_loss)
+        # this is basically the language embeddings
+        factor_embeddings = nn.Embedding(len(dicts['langs']), opt.mpw_factor_size)
 
-    elif opt.model == 'relative_transformer':
-        from onmt.models.relative_transformer import \
-            RelativeTransformerEncoder, RelativeTransformerDecoder
+        encoder.factor_embeddings = factor_embeddings
+        decoder.factor_embeddings = factor_embeddings
 
-        if opt.encoder_type == "text":
-            encoder = RelativeTransformerEncoder(opt, embedding_src, None,
-                                                 opt.encoder_type, language_embeddings=language_embeddings)
-        if opt.encoder_type == "audio":
-            # raise NotImplementedError
-            encoder = RelativeTransformerEncoder(opt, None, None, encoder_type=opt.encoder_type,
-                                                 language_embeddings=language_embeddings)
+    return model
 
-        generator = nn.ModuleList(generators)
-        decoder = RelativeTransformerDecoder(opt, embedding_tgt, None, language_embeddings=language_embeddings)
 
-        if opt.reconstruct:
-            rev_decoder = RelativeTransformerDecoder(opt, embedding_src, None, language_embeddings=language_embeddings)
-            rev_generator = [onmt.modules.base_seq2seq.Generator(opt.model_size, dicts['src'].size(),
-                                                                 fix_norm=opt.fix_norm_output_embedding)]
-            rev_generator = nn.ModuleList(rev_generator)
-        else:
-            rev_decoder = None
-            rev_generator = None
+def _build_lstm(opt, dicts, embedding_src, embedding_tgt, positional_encoder, language_embeddings, generators):
+    onmt.constants.init_value = opt.param_init
 
-        model = RelativeTransformer(encoder, decoder, generator, rev_decoder, rev_generator, mirror=opt.mirror_loss)
+    encoder = SpeechLSTMEncoder(opt, None, opt.encoder_type)
 
-    elif opt.model == 'distance_transformer':
+    decoder = SpeechLSTMDecoder(opt, embedding_tgt, language_embeddings=language_embeddings)
 
-        # from onmt.models.relative_transformer import RelativeTransformerDecoder, RelativeTransformer
-        from onmt.models.distance_transformer import DistanceTransformerEncoder
+    return SpeechLSTMSeq2Seq(encoder, decoder, nn.ModuleList(generators), ctc=opt.ctc_loss > 0.0)
 
-        if opt.encoder_type == "text":
-            encoder = DistanceTransformerEncoder(opt, embedding_src, None,
-                                                 opt.encoder_type, language_embeddings=language_embeddings)
-        if opt.encoder_type == "audio":
-            # raise NotImplementedError
-            encoder = DistanceTransformerEncoder(opt, None, None, encoder_type=opt.encoder_type,
-                                                 language_embeddings=language_embeddings)
 
-        generator = nn.ModuleList(generators)
-        decoder = DistanceTransformerDecoder(opt, embedding_tgt, None, language_embeddings=language_embeddings)
-        model = Transformer(encoder, decoder, generator, mirror=opt.mirror_loss)
+def _build_multilingual_translator(opt, dicts, embedding_src, embedding_tgt, positional_encoder,
+                                   language_embeddings, generators):
+    onmt.constants.init_value = opt.param_init
 
-    elif opt.model == 'universal_transformer':
-        from onmt.models.universal_transformer import UniversalTransformerDecoder, UniversalTransformerEncoder
+    encoder = MultilingualRelativeTransformerEncoder(opt, embedding_src, None,
+                                                     opt.encoder_type, language_embeddings=language_embeddings)
+    decoder = MultilingualRelativeTransformerDecoder(opt, embedding_tgt, None,
+                                                     language_embeddings=language_embeddings)
 
-        generator = nn.ModuleList(generators)
+    return RelativeTransformer(encoder, decoder, nn.ModuleList(generators),
+                               None, None, mirror=opt.mirror_loss)
 
-        if opt.encoder_type == "text":
-            encoder = UniversalTransformerEncoder(opt, embedding_src, positional_encoder,
-                                                  opt.encoder_type, language_embeddings=language_embeddings)
-        elif opt.encoder_type == "audio":
-            encoder = UniversalTransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
 
-        decoder = UniversalTransformerDecoder(opt, embedding_tgt, positional_encoder,
-                                              language_embeddings=language_embeddings)
+def _build_transformer(opt, dicts, embedding_src, embedding_tgt, positional_encoder, language_embeddings,
+                       generators):
+    onmt.constants.init_value = opt.param_init
 
-        model = Transformer(encoder, decoder, generator, mirror=opt.mirror_loss)
+    if opt.encoder_type == "text":
+        encoder = TransformerEncoder(opt, embedding_src, positional_encoder,
+                                     opt.encoder_type, language_embeddings=language_embeddings)
+    elif opt.encoder_type == "audio":
+        encoder = TransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
+    elif opt.encoder_type == "mix":
+        text_encoder = TransformerEncoder(opt, embedding_src, positional_encoder,
+                                          "text", language_embeddings=language_embeddings)
+        audio_encoder = TransformerEncoder(opt, None, positional_encoder, "audio")
+        encoder = MixedEncoder(text_encoder, audio_encoder)
+    else:
+        print("Unknown encoder type:", opt.encoder_type)
+        exit(-1)
+
+    decoder = TransformerDecoder(opt, embedding_tgt, positional_encoder, language_embeddings=language_embeddings)
+
+    return Transformer(encoder, decoder, nn.ModuleList(generators), mirror=opt.mirror_loss)
 
-    elif opt.model == 'relative_universal_transformer':
-        from onmt.models.relative_universal_transformer import \
-            RelativeUniversalTransformerEncoder, RelativeUniversalTransformerDecoder
-        generator = nn.ModuleList(generators)
 
-        if opt.encoder_type == "text":
-            encoder = RelativeUniversalTransformerEncoder(opt, embedding_src, None,
-                                                          opt.encoder_type, language_embeddings=language_embeddings)
-        elif opt.encoder_type == "audio":
-            encoder = RelativeUniversalTransformerDecoder(opt, None, None, opt.encoder_type)
+def _build_relative_transformer(opt, dicts, embedding_src, embedding_tgt, positional_encoder,
+                                language_embeddings, generators):
+    if opt.encoder_type == "text":
+        encoder = RelativeTransformerEncoder(opt, embedding_src, None,
+                                             opt.encoder_type, language_embeddings=language_embeddings)
+    if opt.encoder_type == "audio":
+        # raise NotImplementedError
+        encoder = RelativeTransformerEncoder(opt, None, None, encoder_type=opt.encoder_type,
+                                             language_embeddings=language_embeddings)
+
+    generator = nn.ModuleList(generators)
+    decoder = RelativeTransformerDecoder(opt, embedding_tgt, None, language_embeddings=language_embeddings)
 
-        decoder = RelativeUniversalTransformerDecoder(opt, embedding_tgt, None,
-                                                      language_embeddings=language_embeddings)
+    if opt.reconstruct:
+        rev_decoder = RelativeTransformerDecoder(opt, embedding_src, None, language_embeddings=language_embeddings)
+        rev_generator = [onmt.modules.base_seq2seq.Generator(opt.model_size, dicts['src'].size(),
+                                                             fix_norm=opt.fix_norm_output_embedding)]
+        rev_generator = nn.ModuleList(rev_generator)
+    else:
+        rev_decoder = None
+        rev_generator = None
 
-        model = RelativeTransformer(encoder, decoder, generator, mirror=opt.mirror_loss)
+    return RelativeTransformer(encoder, decoder, generator, rev_decoder, rev_generator, mirror=opt.mirror_loss)
 
-    elif opt.model == 'relative_unified_transformer':
-        from onmt.models.relative_unified_transformer import RelativeUnifiedTransformer
 
-        if opt.encoder_type == "audio":
-            raise NotImplementedError
+def _build_distance_transformer(opt, dicts, embedding_src, embedding_tgt, positional_encoder,
+                                language_embeddings, generators):
+    if opt.encoder_type == "text":
+        encoder = DistanceTransformerEncoder(opt, embedding_src, None,
+                                             opt.encoder_type, language_embeddings=language_embeddings)
+    if opt.encoder_type == "audio":
+        # raise NotImplementedError
+        encoder = DistanceTransformerEncoder(opt, None, None, encoder_type=opt.encoder_type,
+                                             language_embeddings=language_embeddings)
 
-        generator = nn.ModuleList(generators)
-        model = RelativeUnifiedTransformer(opt, embedding_src, embedding_tgt,
-                                           generator, positional_encoder, language_embeddings=language_embeddings)
+    generator = nn.ModuleList(generators)
+    decoder = DistanceTransformerDecoder(opt, embedding_tgt, None, language_embeddings=language_embeddings)
+    return Transformer(encoder, decoder, generator, mirror=opt.mirror_loss)
 
-    elif opt.model == 'memory_transformer':
-        from onmt.models.memory_transformer import MemoryTransformer
 
-        if opt.encoder_type == "audio":
-            raise NotImplementedError
+def _build_universal_transformer(opt, dicts, embedding_src, embedding_tgt, positional_encoder,
+                                 language_embeddings, generators):
+    generator = nn.ModuleList(generators)
 
-        generator = nn.ModuleList(generators)
-        model = MemoryTransformer(opt, embedding_src, embedding_tgt,
-                                  generator, positional_encoder, language_embeddings=language_embeddings,
-                                  dictionary=dicts['tgt'])
+    if opt.encoder_type == "text":
+        encoder = UniversalTransformerEncoder(opt, embedding_src, positional_encoder,
+                                              opt.encoder_type, language_embeddings=language_embeddings)
+    elif opt.encoder_type == "audio":
+        encoder = UniversalTransformerEncoder(opt, None, positional_encoder, opt.encoder_type)
 
-    else:
+    decoder = UniversalTransformerDecoder(opt, embedding_tgt, positional_encoder,
+                                          language_embeddings=language_embeddings)
+
+    return Transformer(encoder, decoder, generator, mirror=opt.mirror_loss)
+
+
+def _build_relative_universal_transformer(opt, dicts, embedding_src, embedding_tgt, positional_encoder,
+                                          language_embeddings, generators):
+    generator = nn.ModuleList(generators)
+
+    if opt.encoder_type == "text":
+        encoder = RelativeUniversalTransformerEncoder(opt, embedding_src, None,
+                                                      opt.encoder_type, language_embeddings=language_embeddings)
+    elif opt.encoder_type == "audio":
+        encoder = RelativeUniversalTransformerDecoder(opt, None, None, opt.encoder_type)
+
+    decoder = RelativeUniversalTransformerDecoder(opt, embedding_tgt, None,
+                                                  language_embeddings=language_embeddings)
+
+    return RelativeTransformer(encoder, decoder, generator, mirror=opt.mirror_loss)
+
+
+def _build_relative_unified_transformer(opt, dicts, embedding_src, embedding_tgt, positional_encoder,
+                                        language_embeddings, generators):
+    if opt.encoder_type == "audio":
         raise NotImplementedError
 
-    if opt.tie_weights:
-        print("* Joining the weights of decoder input and output embeddings")
-        model.tie_weights()
+    generator = nn.ModuleList(generators)
+    return RelativeUnifiedTransformer(opt, embedding_src, embedding_tgt,
+                                      generator, positional_encoder, language_embeddings=language_embeddings)
 
-    return model
+
+def _build_memory_transformer(opt, dicts, embedding_src, embedding_tgt, positional_encoder,
+                              language_embeddings, generators):
+    if opt.encoder_type == "audio":
+        raise NotImplementedError
+
+    generator = nn.ModuleList(generators)
+    return MemoryTransformer(opt, embedding_src, embedding_tgt,
+                             generator, positional_encoder, language_embeddings=language_embeddings,
+                             dictionary=dicts['tgt'])
+
+
+_MODEL_BUILDERS = {
+    'conformer': _build_speech_model,
+    'speech_transformer': _build_speech_model,
+    'hybrid_transformer': _build_speech_model,
+    'LSTM': _build_lstm,
+    'lstm': _build_lstm,
+    'multilingual_translator': _build_multilingual_translator,
+    'translator': _build_multilingual_translator,
+    'transformer': _build_transformer,
+    'stochastic_transformer': _build_transformer,
+    'relative_transformer': _build_relative_transformer,
+    'distance_transformer': _build_distance_transformer,
+    'universal_transformer': _build_universal_transformer,
+    'relative_universal_transformer': _build_relative_universal_transformer,
+    'relative_unified_transformer': _build_relative_unified_transformer,
+    'memory_transformer': _build_memory_transformer,
+}
+
+
+# class name patterns deciding how a module is initialized, checked in order
+_init_class_patterns = [('Linear', 'linear'),
+                        ('Embedding', 'embedding'),
+                        ('LayerNorm', 'layer_norm'),
+                        ('RelativeTransformerEncoder', 'relative_transformer'),
+                        ('RelativeTransformerDecoder', 'relative_transformer'),
+                        ('RelPartialLearnableMultiHeadAttn', 'relative_attention'),
+                        ('EncdecMultiheadAttn', 'reset_parameters'),
+                        ('RelativeSelfMultiheadAttn', 'reset_parameters'),
+                        ('PositionWiseFeedForward', 'reset_parameters')]
+
+# module class -> initialization kind, so the class name is only scanned once per class
+_init_kinds = dict()
+
+
+def _get_init_kind(module):
+    module_class = type(module)
+
+    if module_class not in _init_kinds:
+        classname = module_class.__name__
+        kind = None
+        for pattern, pattern_kind in _init_class_patterns:
+            if classname.find(pattern) != -1:
+                kind = pattern_kind
+                break
+        _init_kinds[module_class] = kind
+
+    return _init_kinds[module_class]
+
+
+def _init_grouped_(tensors, distribution, a, b):
+    """
+    Fill a group of tensors from one distribution with a single random draw
+    (normal: a = mean, b = std; uniform: a = low, b = high)
+    """
+    with torch.no_grad():
+        flat = tensors[0].new_empty(sum(t.numel() for t in tensors))
+        if distribution == 'normal':
+            flat.normal_(a, b)
+        else:
+            flat.uniform_(a, b)
+
+        offset = 0
+        for t in tensors:
+            numel = t.numel()
+            t.copy_(flat[offset:offset + numel].view_as(t))
+            offset += numel
 
 
 def init_model_parameters(model, opt):
@@ -299,18 +449,51 @@ def init_model_parameters(model, opt):
 
     # opt.init something ...
 
+    # tensors sharing the same distribution are collected during the model traversal
+    # and initialized together afterwards (weights of the same shape end up in the same group)
+    init_groups = defaultdict(dict)
+    zero_group = dict()
+
+    def init_grouped(tensor, distribution, a, b):
+        key = (distribution, a, b, tensor.dtype, tensor.device)
+        init_groups[key][id(tensor)] = tensor
+
+    def flush_groups():
+        for (distribution, a, b, _, _), tensors in init_groups.items():
+            _init_grouped_(list(tensors.values()), distribution, a, b)
+        init_groups.clear()
+
+        with torch.no_grad():
+            for tensor in zero_group.values():
+                tensor.zero_()
+        zero_group.clear()
+
+    # the fan-based std of every 2D parameter is computed once up front (keyed by parameter id)
+    matrices = [p for p in model.parameters() if p.dim() == 2]
+    fans = np.array([p.size(0) + p.size(1) for p in matrices], dtype=np.float64)
+    matrix_std = dict(zip((id(p) for p in matrices), np.sqrt(2.0 / fans).tolist()))
+
+    def get_matrix_std(weight):
+        # weights that are not registered parameters (e.g. under weight norm) are computed on the spot
+        std_ = matrix_std.get(id(weight))
+        if std_ is None:
+            std_ = math.sqrt(2.0 / (weight.shape[0] + weight.shape[1]))
+        return std_
+
     def init_weight(weight):
         if opt.init == 'normal':
             if len(weight.shape) == 2:
-                std_ = math.sqrt(2.0 / (weight.shape[0] + weight.shape[1]))
-                nn.init.normal_(weight, 0.0, std_)
+                std_ = get_matrix_std(weight)
+                init_grouped(weight, 'normal', 0.0, std_)
             else:
-                nn.init.normal_(weight, 0.0, init_std)
+                init_grouped(weight, 'normal', 0.0, init_std)
         elif opt.init == 'uniform':
             if len(weight.shape) == 2:
-                nn.init.xavier_uniform_(weight)
+                # same bound as nn.init.xavier_uniform_
+                bound = math.sqrt(3.0) * get_matrix_std(weight)
+                init_grouped(weight, 'uniform', -bound, bound)
             else:
-                nn.init.uniform_(weight, -init_std, init_std)
+                init_grouped(weight, 'uniform', -init_std, init_std)
 
     def init_embed(weight, padding_idx=0):
 
@@ -325,16 +508,20 @@ def init_model_parameters(model, opt):
             nn.init.constant_(weight[padding_idx], 0)
 
     def init_bias(bias):
-        nn.init.constant_(bias, 0.0)
+        zero_group[id(bias)] = bias
 
     def weights_init(m):
-        classname = m.__class__.__name__
-        if classname.find('Linear') != -1:
-            if hasattr(m, 'weight') and m.weight is not None:
+        kind = _get_init_kind(m)
+        if kind is None:
+            return
+
+        if kind == 'linear':
+            # an output layer tied to an embedding keeps the embedding initialization
+            if hasattr(m, 'weight') and m.weight is not None and id(m.weight) not in embedding_weights:
                 init_weight(m.weight)
             if hasattr(m, 'bias') and m.bias is not None:
                 init_bias(m.bias)
-        elif classname.find('Embedding') != -1:
+        elif kind == 'embedding':
 
             initialize = True
             if hasattr(m, "no_need_to_initialize"):
@@ -345,25 +532,15 @@ def init_model_parameters(model, opt):
                     init_embed(m.weight, m.padding_idx)
             # nn.init.constant_(m.weight[m.padding_idx], 0.0)
 
-        elif classname.find('LayerNorm') != -1 or classname.find('FusedLayerNorm') != -1:
+        elif kind == 'layer_norm':
             if hasattr(m, 'weight'):
                 if opt.init == 'normal':
-                    nn.init.normal_(m.weight, 1.0, init_std)
+                    init_grouped(m.weight, 'normal', 1.0, init_std)
                 else:
-                    nn.init.uniform_(m.weight, 1.0 - init_std, 1.0 + init_std)
+                    init_grouped(m.weight, 'uniform', 1.0 - init_std, 1.0 + init_std)
             if hasattr(m, 'bias') and m.bias is not None:
                 init_bias(m.bias)
-            pass
-        elif classname.find('RelativeTransformerEncoder') != -1:
-            if hasattr(m, 'r_emb'):
-                init_weight(m.r_emb)
-            if hasattr(m, 'r_w_bias'):
-                init_weight(m.r_w_bias)
-            if hasattr(m, 'r_r_bias'):
-                init_weight(m.r_r_bias)
-            if hasattr(m, 'r_bias'):
-                init_bias(m.r_bias)
-        elif classname.find('RelativeTransformerDecoder') != -1:
+        elif kind == 'relative_transformer':
             if hasattr(m, 'r_emb'):
                 init_weight(m.r_emb)
             if hasattr(m, 'r_w_bias'):
@@ -372,24 +549,20 @@ def init_model_parameters(model, opt):
                 init_weight(m.r_r_bias)
             if hasattr(m, 'r_bias'):
                 init_bias(m.r_bias)
-        elif classname.find('RelPartialLearnableMultiHeadAttn') != -1:
+        elif kind == 'relative_attention':
             if hasattr(m, 'r_w_bias'):
                 init_weight(m.r_w_bias)
             if hasattr(m, 'r_r_bias'):
                 init_weight(m.r_r_bias)
-        elif classname.find('EncdecMultiheadAttn') != -1:
-            m.reset_parameters(init=opt.init)
-        elif classname.find('RelativeSelfMultiheadAttn') != -1:
-            m.reset_parameters(init=opt.init)
-        elif classname.find('PositionWiseFeedForward') != -1:
+        elif kind == 'reset_parameters':
             m.reset_parameters(init=opt.init)
 
-    model.apply(weights_init)
+    embedding_weights = set(id(m.weight) for m in model.modules()
+                            if _get_init_kind(m) == 'embedding'
+                            and isinstance(getattr(m, 'weight', None), torch.Tensor))
 
-    if hasattr(model, 'decoder'):
-        model.decoder.word_lut.apply(weights_init)
-    else:
-        model.tgt_embedding.apply(weights_init)
+    model.apply(weights_init)
+    flush_groups()
 
     if opt.multilingual_partitioned_weights:
         factor_embeddings = model.encoder.factor_embeddings
@@ -411,8 +584,7 @@ def build_language_model(opt, dicts):
     onmt.constants.version = 1.0
     onmt.constants.attention_out = opt.attention_out
     onmt.constants.residual_type = opt.residual_type
-
-    from onmt.models.transformer_xl import TransformerXL
+    onmt.constants.bf16 = opt.bf16
 
     embedding_tgt = nn.Embedding(dicts['tgt'].size(),
                                  opt.model_size,
@@ -465,24 +637,20 @@ def optimize_model(model, fp16=True, distributed=False):
 
     def replace_layer_norm(m, name):
 
-        replacable = True
-        try:
-            # from apex.normalization.fused_layer_norm import FusedLayerNorm
-            import importlib
-            from apex.normalization.fused_layer_norm import FusedLayerNorm
-            fused_layer_norm_cuda = importlib.import_module("fused_layer_norm_cuda")
-
-        except ModuleNotFoundError:
-            replacable = False
-
-        if replacable:
-            for attr_str in dir(m):
-                target_attr = getattr(m, attr_str)
-                if type(target_attr) == torch.nn.LayerNorm:
-                    setattr(m, attr_str, FusedLayerNorm(target_attr.normalized_shape,
-                                                        eps=target_attr.eps,
-                                                        elementwise_affine=target_attr.elementwise_affine))
-            for n, ch in m.named_children():
+        if not _FUSED_LN_AVAILABLE:
+            return
+
+        # only the direct children have to be visited: the recursion covers the rest of the tree
+        for n, ch in list(m.named_children()):
+            if type(ch) == torch.nn.LayerNorm:
+                fused = _FusedLayerNorm(ch.normalized_shape, eps=ch.eps,
+                                        elementwise_affine=ch.elementwise_affine)
+                # keep the existing parameters (and their values) instead of the freshly allocated ones
+                if ch.elementwise_affine:
+                    fused.weight = ch.weight
+                    fused.bias = ch.bias
+                setattr(m, n, fused)
+            else:
                 replace_layer_norm(ch, n)
 
     def safe_batch_norm(m, name):
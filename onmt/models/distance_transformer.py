@@ -203,8 +203,7 @@ class DistanceTransformerDecoder(TransformerDecoder):
         super(DistanceTransformerDecoder, self).__init__(opt, dicts,
                                                          positional_encoder,
                                                          language_embeddings,
-                                                         ignore_source,
-                                                         allocate_positions=False)
+                                                         ignore_source)
         self.positional_encoder = SinusoidalPositionalEmbedding(opt.model_size)
         self.d_head = self.model_size // self.n_heads
         # Parameters for the position biases
@@ -505,15 +505,6 @@ class RelativeUnifiedTransformer(UnifiedTransformer):
 
         return gold_words, gold_scores, allgold_scores
 
-    def renew_buffer(self, new_len):
-
-        # This model uses pre-allocated position encoding
-        self.positional_encoder.renew(new_len)
-        mask = torch.ByteTensor(np.triu(np.ones((new_len + 1, new_len + 1)), k=1).astype('uint8'))
-        self.register_buffer('mask', mask)
-
-        return
-
     def reset_states(self):
         return
 
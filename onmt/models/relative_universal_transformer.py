@@ -188,7 +188,7 @@ class RelativeUniversalTransformerDecoder(TransformerDecoder):
         super(RelativeUniversalTransformerDecoder, self).__init__(opt, dicts,
                                                                   positional_encoder,
                                                                   language_embeddings,
-                                                                  ignore_source, allocate_positions=False)
+                                                                  ignore_source)
 
         self.positional_encoder = SinusoidalPositionalEmbedding(opt.model_size)
         # Parameters for the position biases
@@ -310,7 +310,6 @@ class RelativeUniversalTransformerDecoder(TransformerDecoder):
         else:
             input_ = input
         """ Embedding: batch_size x 1 x d_model """
-        check = input_.gt(self.word_lut.num_embeddings)
         emb = self.word_lut(input)
 
         """ Adding positional encoding """
@@ -234,8 +234,7 @@ class SpeechTransformerDecoder(TransformerDecoder):
 
         # build_modules will be called from the inherited constructor
         super().__init__(opt, dicts, positional_encoder, language_embeddings,
-                         ignore_source,
-                         allocate_positions=False)
+                         ignore_source)
         self.positional_encoder = SinusoidalPositionalEmbedding(opt.model_size)
         self.d_head = self.model_size // self.n_heads
         # Parameters for the position biases - deprecated. kept for backward compatibility
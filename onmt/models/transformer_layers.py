@@ -1,7 +1,7 @@
+import importlib
 import math
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.init as init
 import torch.nn.utils.weight_norm as WeightNorm
 import onmt
@@ -20,6 +20,29 @@ from onmt.modules.optimized.feed_forward import PositionWiseFeedForward
 from collections import defaultdict
 from onmt.modules.layer_norm import LayerNorm
 
+try:
+    from apex.normalization.fused_layer_norm import FusedLayerNorm
+    # apex can be installed without its CUDA extensions, the module is only usable with the extension
+    importlib.import_module("fused_layer_norm_cuda")
+except (ModuleNotFoundError, ImportError) as e:
+    FusedLayerNorm = None
+
+
+@torch.jit.script
+def fused_dropout_residual(x, residual, prob, is_training):
+    # type: (Tensor, Tensor, float, bool) -> Tensor
+    out = F.dropout(x, p=prob, training=is_training)
+    out = residual + out
+    return out
+
+
+@torch.jit.script
+def fused_dropout_gated_residual(x, residual, k, prob, is_training):
+    # type: (Tensor, Tensor, Tensor, float, bool) -> Tensor
+    out = F.dropout(x, p=prob, training=is_training)
+    out = residual + F.relu(k) * out
+    return out
+
 
 class PrePostProcessing(nn.Module):
     """Applies processing to tensors
@@ -39,36 +62,101 @@ class PrePostProcessing(nn.Module):
 
         self.steps = list(sequence)
 
-        if onmt.constants.residual_type == 'gated':
+        # the residual type is set globally before the model is built, so it is only read once here
+        self.gated_residual = onmt.constants.residual_type == 'gated'
+        if self.gated_residual:
             # gated residual
             # initialize k with one 
             self.k = nn.Parameter(torch.ones(1))
 
+        self.fused_layer_norm = FusedLayerNorm is not None
         if 'n' in self.steps:
-            ln = nn.LayerNorm((self.d_model,), elementwise_affine=elementwise_affine)
-            self.layer_norm = Bottle(ln)
+            if self.fused_layer_norm:
+                # the apex kernel handles arbitrary leading dimensions so the Bottle wrapper is not needed
+                self.layer_norm = FusedLayerNorm((self.d_model,), elementwise_affine=elementwise_affine)
+            else:
+                ln = nn.LayerNorm((self.d_model,), elementwise_affine=elementwise_affine)
+                self.layer_norm = Bottle(ln)
         if 'd' in self.steps:
             if variational:
                 self.dropout = VariationalDropout(self.dropout_p, batch_first=False)
             else:
                 self.dropout = nn.Dropout(self.dropout_p)
 
+        # dropout directly followed by the residual connection ('da') is done in one scripted function
+        # so that the tensor is only traversed once
+        self.fuse_dropout_residual = not variational and 'da' in sequence
+
+        # resolve the processing steps once, so that forward does not compare strings for every call
+        # (unbound functions are stored to keep deepcopy and module replication safe)
+        self._ops = []
+        for i, step in enumerate(self.steps):
+            if step == 'n':
+                self._ops.append(PrePostProcessing._normalize)
+            elif step == 'd':
+                if self.fuse_dropout_residual and self.steps[i + 1:i + 2] == ['a']:
+                    self._ops.append(PrePostProcessing._dropout_residual)
+                else:
+                    self._ops.append(PrePostProcessing._dropout)
+            elif step == 'a':
+                if not (self.fuse_dropout_residual and self.steps[i - 1:i] == ['d']):
+                    self._ops.append(PrePostProcessing._residual)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # checkpoints can be created with or without apex, so the layer norm keys
+        # may or may not contain the "function" level of the Bottle wrapper
+        if 'n' in self.steps:
+            bottled = prefix + 'layer_norm.function.'
+            plain = prefix + 'layer_norm.'
+            for name in ['weight', 'bias']:
+                if self.fused_layer_norm and bottled + name in state_dict:
+                    state_dict[plain + name] = state_dict.pop(bottled + name)
+                elif not self.fused_layer_norm and plain + name in state_dict:
+                    state_dict[bottled + name] = state_dict.pop(plain + name)
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
+    def _normalize(self, output, input_tensor):
+        # this cast is needed for O1 and FusedLayerNorm
+        if self.fused_layer_norm:
+            output = self.layer_norm(output.type_as(self.layer_norm.weight))
+        else:
+            output = self.layer_norm(output.type_as(self.layer_norm.function.weight))
+        return output
+
+    def _dropout(self, output, input_tensor):
+        return self.dropout(output)
+
+    def _residual(self, output, input_tensor):
+        if input_tensor is not None:
+            if not self.gated_residual:
+                output = output + input_tensor
+            else:
+                # input + relu(k) * output in one kernel, without the intermediate scaled tensor
+                output = torch.addcmul(input_tensor, output, F.relu(self.k))
+        return output
+
+    def _dropout_residual(self, output, input_tensor):
+        if input_tensor is None:
+            return self.dropout(output)
+
+        if not self.gated_residual:
+            return fused_dropout_residual(output, input_tensor, self.dropout_p, self.training)
+        else:
+            return fused_dropout_gated_residual(output, input_tensor, self.k, self.dropout_p, self.training)
+
     def forward(self, tensor, input_tensor=None, mask=None):
+        """
+        :param tensor: input tensor [TxBxH]
+        :param input_tensor: previous tensor for residual
+        :param mask: unused (layer norm is position-wise)
+        """
 
         output = tensor
-        for step in self.steps:
-            if step == 'n':
-                # this cast is needed for O1 and FusedLayerNorm
-                output = self.layer_norm(output.type_as(self.layer_norm.function.weight), mask=mask)
-                output = output
-            if step == 'd':
-                output = self.dropout(output)
-            if step == 'a':
-                if input_tensor is not None:
-                    if onmt.constants.residual_type != 'gated':
-                        output = output + input_tensor
-                    else:
-                        output = F.relu(self.k) * output + input_tensor
+        for op in self._ops:
+            output = op(self, output, input_tensor)
         return output
 
 
@@ -123,19 +211,27 @@ class EncoderLayer(nn.Module):
             self.feedforward = PositionWiseFeedForward(opt.model_size, opt.inner_size, opt.dropout,
                                                        variational=self.variational)
 
-    def forward(self, input, attn_mask):
+    def forward(self, input, attn_mask, cu_seqlens=None, max_seqlen=None):
+        """
+        :param input: len_query x batch_size x d_model, or total_len x 1 x d_model when cu_seqlens is given
+        :param attn_mask: the padding mask (unused for packed inputs)
+        :param cu_seqlens: cumulative sequence lengths of the packed input (see MultiHeadAttention.varlen_forward)
+        :param max_seqlen: the length of the longest sequence in the packed input
+        """
 
         coin = True
-        if self.training:
+        if self.training and self.death_rate > 0:
             coin = (torch.rand(1)[0].item() >= self.death_rate)
 
         if coin:
             query = self.preprocess_attn(input)
 
-            if self.fast_self_attention:
+            if cu_seqlens is not None:
+                out, _ = self.multihead.varlen_forward(query, cu_seqlens, max_seqlen)
+            elif self.fast_self_attention:
                 out, _ = self.multihead(query, query, query, attn_mask, None)
             else:
-                out, _ = self.multihead(query, query, query, attn_mask)
+                out, _ = self.multihead(query, query, query, attn_mask, need_weights=False)
 
             if self.training and self.death_rate > 0:
                 out = out / (1 - self.death_rate)
@@ -242,7 +338,7 @@ class DecoderLayer(nn.Module):
         coverage = None
 
         coin = True
-        if self.training:
+        if self.training and self.death_rate > 0:
             coin = (torch.rand(1)[0].item() >= self.death_rate)
 
         if coin:
@@ -256,7 +352,8 @@ class DecoderLayer(nn.Module):
             else:
                 out, _, = self.multihead_tgt(query, query, query, mask_tgt,
                                              incremental=incremental,
-                                             incremental_cache=incremental_cache)
+                                             incremental_cache=incremental_cache,
+                                             need_weights=False)
 
             if self.training and self.death_rate > 0:
                 out = out / (1 - self.death_rate)
@@ -321,7 +418,6 @@ class PositionalEncoding(nn.Module):
         super(PositionalEncoding, self).__init__()
         self.len_max = len_max
         self.d_model = d_model
-        self.data_type = None
 
         self.renew(len_max)
 
@@ -329,10 +425,9 @@ class PositionalEncoding(nn.Module):
 
     def renew(self, new_max_len):
         # detele the old variable to avoid Pytorch's error when register new buffer
-        cuda = False
+        device = torch.device('cpu')
         if hasattr(self, 'pos_emb'):
-            cuda = self.pos_emb.is_cuda
-            # self.data_type = torch.type(self.pos_emb)
+            device = self.pos_emb.device
             del self.pos_emb
 
         position = torch.arange(0, new_max_len).float()
@@ -343,47 +438,76 @@ class PositionalEncoding(nn.Module):
         scaled_time = position.unsqueeze(1) * inv_timescales.unsqueeze(0)
         pos_emb = torch.cat((torch.sin(scaled_time), torch.cos(scaled_time)), 1)
 
-        if cuda:
-            pos_emb = pos_emb.cuda()
+        # keep the device of the previous table (the table itself stays in fp32)
+        pos_emb = pos_emb.to(device=device)
 
-        if self.data_type is not None:
-            pos_emb.type(self.data_type)
         # wrap in a buffer so that model can be moved to GPU
-        self.register_buffer('pos_emb', pos_emb)
-        # self.data_type = self.pos_emb.type()
+        # the table is deterministic, so it is not saved: the module is shared by encoder and decoder
+        # and would otherwise be stored once for every reference in the state dict
+        self.register_buffer('pos_emb', pos_emb, persistent=False)
         self.len_max = new_max_len
 
-    def forward(self, word_emb, t=None):
+        # copy of the table in the precision / on the device of the inputs, see _table
+        self._cast_table = None
 
-        len_seq = t if t else word_emb.size(1)
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # older checkpoints still contain the table (possibly with a different length)
+        state_dict.pop(prefix + 'pos_emb', None)
 
-        self.data_type = word_emb.type()
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
 
+    def _table(self, word_emb, len_seq):
+        """
+        Return the table with at least len_seq positions in the precision and on the device of word_emb.
+        The converted copy is cached (the module is shared by the encoder and the decoder) instead of
+        casting the slice on every call, the buffer itself keeps its precision
+        """
         if len_seq > self.len_max:
             self.renew(len_seq)
 
+        if self.pos_emb.dtype == word_emb.dtype and self.pos_emb.device == word_emb.device:
+            return self.pos_emb
+
+        table = self._cast_table
+        if table is None or table.dtype != word_emb.dtype or table.device != word_emb.device \
+                or table.size(0) != self.pos_emb.size(0):
+            table = self.pos_emb.to(word_emb)
+            self._cast_table = table
+
+        return table
+
+    def forward(self, word_emb, t=None, scale=1.0):
+        """
+        :param word_emb: batch_size x len_seq x d_model
+        :param t: the current time step (for incremental decoding)
+        :param scale: multiplied with word_emb in the same kernel as the addition
+        """
+
+        len_seq = t if t else word_emb.size(1)
+        pos_emb = self._table(word_emb, len_seq)
+
         if word_emb.size(1) == len_seq:
-            time_ = self.pos_emb[:len_seq, :].type_as(word_emb)
-            out = word_emb + time_
+            time_ = pos_emb[:len_seq]
         else:
-            # out = word_emb + Variable(self.pos_emb[:len_seq, :][-1, :], requires_grad=False)
-            time_emb = self.pos_emb[len_seq - 1, :]  # 1 x dim
+            # a single decoding step: only the row of the current position is needed
             # out should have size bs x 1 x dim
-            out = word_emb + time_emb.unsqueeze(0).repeat(word_emb.size(0), 1, 1).type_as(word_emb)
+            time_ = pos_emb[len_seq - 1]  # dim
+
+        # time_ + scale * word_emb, broadcast over the batch
+        out = torch.add(time_, word_emb, alpha=scale)
         return out
 
     def get_positional_embeddings(self, word_emb, t=None):
 
         len_seq = t if t else word_emb.size(1)
-
-        self.data_type = word_emb.type()
-        if len_seq > self.len_max:
-            self.renew(len_seq)
+        pos_emb = self._table(word_emb, len_seq)
 
         if word_emb.size(1) == len_seq:
-            time_emb = self.pos_emb[:len_seq, :].type_as(word_emb)
+            time_emb = pos_emb[:len_seq]
 
         else:
-            time_emb = self.pos_emb[len_seq - 1, :].unsqueeze(0).type_as(word_emb)
+            time_emb = pos_emb[len_seq - 1].unsqueeze(0)
 
         return time_emb
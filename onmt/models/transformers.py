@@ -1,6 +1,7 @@
+import contextlib
 import copy
+import functools
 import math
-import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
@@ -13,13 +14,34 @@ from onmt.models.transformer_layers import EncoderLayer, DecoderLayer, Positiona
 from onmt.modules.base_seq2seq import NMTModel, Reconstructor, DecoderState
 from onmt.modules.dropout import embedded_dropout, switchout
 from onmt.modules.linear import FeedForward, FeedForwardSwish
+from onmt.modules.attention import flash_attn_varlen_func
 from onmt.reversible_models.transformers import ReversibleTransformerEncoderLayer, ReversibleEncoderFunction, \
     ReversibleDecoderFunction, ReversibleTransformerDecoderLayer
-from onmt.utils import flip, expected_length
+from onmt.utils import flip, expected_length, append_to_cache, reorder_cache
 
 torch_version = float(torch.__version__[:3])
 
 
+def checkpoint_segments(n_layers):
+    """
+    Split a stack of n_layers into about sqrt(n_layers) contiguous segments for gradient checkpointing
+    :return: list of (start, end) layer indices
+    """
+    n_segments = max(1, int(math.sqrt(n_layers)))
+    segment_size = int(math.ceil(n_layers / n_segments))
+    return [(start, min(start + segment_size, n_layers)) for start in range(0, n_layers, segment_size)]
+
+
+@functools.lru_cache(maxsize=8)
+def _causal_mask(size, device):
+    """
+    size x size bool mask with True above the diagonal (the future positions).
+    The mask is deterministic and never written to, so one tensor per (size, device) is shared
+    by every decoder instead of each of them holding its own buffer
+    """
+    return torch.ones(size, size, dtype=torch.bool, device=device).triu_(1)
+
+
 class MixedEncoder(nn.Module):
 
     def __init(self, text_encoder, audio_encoder):
@@ -83,6 +105,12 @@ class TransformerEncoder(nn.Module):
         self.time = opt.time
         self.lsh_src_attention = opt.lsh_src_attention
         self.reversible = opt.src_reversible
+        self.checkpointing = opt.checkpointing
+
+        # the packed (padding-free) self-attention needs flash_attn and
+        # layers without per-sequence state (variational dropout masks, apex attention, lsh, reversible)
+        self.varlen_attention = opt.varlen_attention and flash_attn_varlen_func is not None and \
+            not (opt.variational_dropout or opt.fast_self_attention or self.lsh_src_attention or self.reversible)
 
         # disable word dropout when switch out is in action
         if self.switchout > 0.0:
@@ -154,6 +182,14 @@ class TransformerEncoder(nn.Module):
 
             self.layer_modules.append(block)
 
+    def create_segment_function(self, start, end, **layer_kwargs):
+        def forward_pass(context, mask_src):
+            for layer in self.layer_modules[start:end]:
+                context = layer(context, mask_src, **layer_kwargs)
+            return context
+
+        return forward_pass
+
     def forward(self, input, input_lang=None, **kwargs):
         """
         Inputs Shapes:
@@ -202,11 +238,8 @@ class TransformerEncoder(nn.Module):
 
         mask_src = mask_src.bool()
 
-        """ Scale the emb by sqrt(d_model) """
-        emb = emb * math.sqrt(self.model_size)
-
-        """ Adding positional encoding """
-        emb = self.time_transformer(emb)
+        """ Scale the emb by sqrt(d_model) and add positional encoding """
+        emb = self.time_transformer(emb, scale=math.sqrt(self.model_size))
 
         """ Adding language embeddings """
         if self.use_language_embedding:
@@ -221,17 +254,52 @@ class TransformerEncoder(nn.Module):
 
         context = self.preprocess_layer(context)
 
+        # flash attention only runs in half/bfloat16
+        # the number of non-padded source tokens (src_size) has to be known on the host to pack without a sync
+        src_size = kwargs.get('src_size', None)
+        varlen = self.varlen_attention and context.is_cuda and src_size is not None and \
+            self.input_type == 'text' and \
+            (context.dtype in (torch.half, torch.bfloat16) or torch.is_autocast_enabled())
+        layer_kwargs = dict()
+
+        if varlen:
+            # drop the padded positions: the layers work on the packed total_len x 1 x d_model tensor and
+            # the self-attention uses the cumulative sequence lengths instead of the padding mask
+            len_src, batch_size, d_model = context.size()
+            keep = ~mask_src.squeeze(1)  # batch_size x len_src
+            lengths = keep.sum(dim=1, dtype=torch.int32)
+            layer_kwargs['cu_seqlens'] = F.pad(lengths.cumsum(0, dtype=torch.int32), (1, 0))
+            # the padded length is an upper bound known on the host
+            layer_kwargs['max_seqlen'] = len_src
+
+            # a stable sort moves the (batch major) non-padded positions to the front in their order,
+            # the number of them is known, so no boolean indexing (and no sync) is needed
+            bt_index = torch.sort(mask_src.view(-1).int(), stable=True)[1][:src_size]
+            # the same positions in the time major layout of the output
+            tb_index = (bt_index % len_src) * batch_size + torch.div(bt_index, len_src, rounding_mode='floor')
+            context = context.transpose(0, 1).reshape(-1, d_model).index_select(0, bt_index).unsqueeze(1)
+
         if self.reversible:
             # x_1 and x_2 are the same at first for reversible
             context = torch.cat([context, context], dim=-1)
 
             context = ReversibleEncoderFunction.apply(context, self.layer_modules, mask_src)
+        elif self.checkpointing > 0 and self.training:
+            # only the segment boundaries are kept, the layers inside are recomputed during backward
+            for start, end in checkpoint_segments(len(self.layer_modules)):
+                context = checkpoint(self.create_segment_function(start, end, **layer_kwargs), context, mask_src)
         else:
             for i, layer in enumerate(self.layer_modules):
-                context = layer(context, mask_src)  # batch_size x len_src x d_model
+                context = layer(context, mask_src, **layer_kwargs)  # batch_size x len_src x d_model
 
         context = self.postprocess_layer(context)
 
+        if varlen:
+            # scatter back into len_src x batch_size x d_model, the padded positions are zero
+            packed = context.squeeze(1)
+            context = packed.new_zeros(len_src * batch_size, d_model).index_copy_(0, tb_index, packed)
+            context = context.view(len_src, batch_size, d_model)
+
         output_dict = {'context': context, 'src_mask': mask_src}
 
         # return context, mask_src
@@ -242,7 +310,7 @@ class TransformerDecoder(nn.Module):
     """Decoder in 'Attention is all you need'"""
 
     def __init__(self, opt, embedding, positional_encoder,
-                 language_embeddings=None, ignore_source=False, allocate_positions=True):
+                 language_embeddings=None, ignore_source=False):
         """
         :param opt:
         :param embedding:
@@ -270,6 +338,7 @@ class TransformerDecoder(nn.Module):
         self.use_language_embedding = opt.use_language_embedding
         self.language_embedding_type = opt.language_embedding_type
         self.reversible = opt.tgt_reversible
+        self.checkpointing = opt.checkpointing
 
         if self.switchout > 0:
             self.word_dropout = 0
@@ -291,12 +360,6 @@ class TransformerDecoder(nn.Module):
 
         self.positional_encoder = positional_encoder
 
-        if allocate_positions:
-            if hasattr(self.positional_encoder, 'len_max'):
-                len_max = self.positional_encoder.len_max
-                mask = torch.ByteTensor(np.triu(np.ones((len_max, len_max)), k=1).astype('uint8'))
-                self.register_buffer('mask', mask)
-
         self.layer_modules = nn.ModuleList()
         self.build_modules()
 
@@ -322,11 +385,39 @@ class TransformerDecoder(nn.Module):
 
             self.layer_modules.append(block)
 
+    def create_segment_function(self, start, end):
+        # context is passed explicitly so that its gradient reaches the encoder
+        def forward_pass(output, context, mask_tgt, mask_src):
+            coverage = None
+            for layer in self.layer_modules[start:end]:
+                output, coverage, _ = layer(output, context, mask_tgt, mask_src)
+            return output, coverage
+
+        return forward_pass
+
     def renew_buffer(self, new_len):
 
         self.positional_encoder.renew(new_len)
-        mask = torch.ByteTensor(np.triu(np.ones((new_len + 1, new_len + 1)), k=1).astype('uint8'))
-        self.register_buffer('mask', mask)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # older checkpoints still contain the causal mask buffer
+        state_dict.pop(prefix + 'mask', None)
+
+        super()._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                      missing_keys, unexpected_keys, error_msgs)
+
+    @staticmethod
+    def causal_mask(len_tgt, device):
+        """
+        :param len_tgt: target length
+        :param device: device of the decoder inputs
+        :return: 1 x len_tgt x len_tgt bool mask (True for future positions), a view of the shared mask
+        """
+        # round up to a power of two so that a few cached masks cover all lengths
+        size = 1 << max(len_tgt - 1, 63).bit_length()
+
+        return _causal_mask(size, torch.device(device))[:len_tgt, :len_tgt].unsqueeze(0)
 
     def process_embedding(self, input, input_lang=None):
 
@@ -339,10 +430,11 @@ class TransformerDecoder(nn.Module):
         input_ = input
 
         emb = embedded_dropout(self.word_lut, input_, dropout=self.word_dropout if self.training else 0)
+        """ Scale the emb by sqrt(d_model) and add positional encoding """
         if self.time == 'positional_encoding':
-            emb = emb * math.sqrt(self.model_size)
-        """ Adding positional encoding """
-        emb = self.time_transformer(emb)
+            emb = self.time_transformer(emb, scale=math.sqrt(self.model_size))
+        else:
+            emb = self.time_transformer(emb)
 
         if self.use_language_embedding:
             lang_emb = self.language_embeddings(input_lang)  # B x H or 1 x H
@@ -363,8 +455,8 @@ class TransformerDecoder(nn.Module):
     def forward(self, input, context, src, tgt_lang=None, **kwargs):
         """
         Inputs Shapes:
-            input: (Variable) batch_size x len_tgt (to be transposed)
-            context: (Variable) batch_size x len_src x d_model
+            input: (Tensor) batch_size x len_tgt (to be transposed)
+            context: (Tensor) batch_size x len_src x d_model
             mask_src (Tensor) batch_size x len_src
         Outputs Shapes:
             out: batch_size x len_tgt x d_model
@@ -379,24 +471,20 @@ class TransformerDecoder(nn.Module):
         if context is not None:
             if self.encoder_type == "audio":
                 if not self.encoder_cnn_downsampling:
-                    mask_src = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
+                    mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
                 else:
-                    long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
+                    long_mask = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                     mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
             else:
 
-                mask_src = src.data.eq(onmt.constants.PAD).unsqueeze(1)
+                mask_src = src.eq(onmt.constants.PAD).unsqueeze(1)
         else:
             mask_src = None
 
         len_tgt = input.size(1)
-        # mask_tgt = input.eq(onmt.constants.PAD).byte().unsqueeze(1) + self.mask[:len_tgt, :len_tgt]
-        # mask_tgt = torch.gt(mask_tgt, 0)
-        mask_tgt = torch.triu(
-                emb.new_ones(len_tgt, len_tgt), diagonal=1).byte().unsqueeze(0)
-
-        mask_tgt = mask_tgt.bool()
+        mask_tgt = self.causal_mask(len_tgt, emb.device)
 
+        # this is a real copy into the time-first layout (not a no-op), the layers expect T x B x H
         output = self.preprocess_layer(emb.transpose(0, 1).contiguous())
 
         if self.reversible:
@@ -406,6 +494,11 @@ class TransformerDecoder(nn.Module):
             output = ReversibleDecoderFunction.apply(output, context, self.layer_modules,
                                                      mask_tgt, mask_src)
             coverage = None
+        elif self.checkpointing > 0 and self.training:
+            # only the segment boundaries are kept, the layers inside are recomputed during backward
+            for start, end in checkpoint_segments(len(self.layer_modules)):
+                output, coverage = checkpoint(self.create_segment_function(start, end),
+                                              output, context, mask_tgt, mask_src)
         else:
             for i, layer in enumerate(self.layer_modules):
                 output, coverage, _ = layer(output, context, mask_tgt, mask_src)  # batch_size x len_src x d_model
@@ -421,8 +514,8 @@ class TransformerDecoder(nn.Module):
     def step(self, input, decoder_state, **kwargs):
         """
         Inputs Shapes:
-            input: (Variable) batch_size x len_tgt (to be transposed)
-            context: (Variable) batch_size x len_src x d_model
+            input: (Tensor) batch_size x len_tgt (to be transposed)
+            context: (Tensor) batch_size x len_src x d_model
             mask_src (Tensor) batch_size x len_src
             buffer (List of tensors) List of batch_size * len_tgt-1 * d_model for self-attention recomputing
         Outputs Shapes:
@@ -450,12 +543,10 @@ class TransformerDecoder(nn.Module):
         else:
             input_ = input
         """ Embedding: batch_size x 1 x d_model """
-        check = input_.gt(self.word_lut.num_embeddings)
         emb = self.word_lut(input_)
 
-        """ Adding positional encoding """
-        emb = emb * math.sqrt(self.model_size)
-        emb = self.time_transformer(emb, t=input.size(1))
+        """ Scale the emb by sqrt(d_model) and add positional encoding """
+        emb = self.time_transformer(emb, t=input.size(1), scale=math.sqrt(self.model_size))
         # emb should be batch_size x 1 x dim
 
         if self.use_language_embedding:
@@ -478,11 +569,19 @@ class TransformerDecoder(nn.Module):
         emb = emb.transpose(0, 1)
 
         # batch_size x 1 x len_src
-        if context is not None:
+        # the source mask only changes when the source is reordered or pruned, so it is kept in the state
+        # (the version counter also catches the in-place reordering of update_beam)
+        src_mask_cache = getattr(decoder_state, 'src_mask_cache', None)
+        if context is None:
+            mask_src = None
+        elif src_mask_cache is not None and src_mask_cache[0] is decoder_state.src \
+                and src_mask_cache[1] == decoder_state.src._version:
+            mask_src = src_mask_cache[2]
+        else:
             if self.encoder_type == "audio":
                 if src.dim() == 3:
                     if self.encoder_cnn_downsampling:
-                        long_mask = src.data.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
+                        long_mask = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD)
                         mask_src = long_mask[:, 0:context.size(0) * 4:4].unsqueeze(1)
                     else:
                         mask_src = src.narrow(2, 0, 1).squeeze(2).eq(onmt.constants.PAD).unsqueeze(1)
@@ -493,19 +592,14 @@ class TransformerDecoder(nn.Module):
                     mask_src = src.eq(onmt.constants.PAD).unsqueeze(1)
             else:
                 mask_src = src.eq(onmt.constants.PAD).unsqueeze(1)
-        else:
-            mask_src = None
+            decoder_state.src_mask_cache = (decoder_state.src, decoder_state.src._version, mask_src)
 
         len_tgt = input.size(1)
-        mask_tgt = torch.triu(
-            emb.new_ones(len_tgt, len_tgt), diagonal=1).byte().unsqueeze(0)
         # only get the final step of the mask during decoding (because the input of the network is only the last step)
-        mask_tgt = mask_tgt[:, -1, :].unsqueeze(1)
-
-        if torch_version >= 1.2:
-            mask_tgt = mask_tgt.bool()
+        mask_tgt = self.causal_mask(len_tgt, emb.device)[:, -1:, :]
 
-        output = emb.contiguous()
+        # 1 x batch_size x d_model is already contiguous after the transpose
+        output = emb
 
         if self.reversible:
             # x_1 and x_2 are the same at first for reversible
@@ -565,6 +659,18 @@ class Transformer(NMTModel):
         if self.ctc:
             self.ctc_linear = nn.Linear(encoder.model_size, self.tgt_vocab_size)
 
+        self.bf16 = onmt.constants.bf16 and hasattr(torch, 'autocast')
+
+    def autocast(self, device):
+        """
+        :param device: the device of the input
+        :return: a bfloat16 autocast context on cuda if bf16 is enabled, otherwise a no-op context
+        """
+        if self.bf16 and device.type == 'cuda':
+            return torch.autocast(device_type='cuda', dtype=torch.bfloat16)
+
+        return contextlib.nullcontext()
+
     def reset_states(self):
         return
 
@@ -597,99 +703,103 @@ class Transformer(NMTModel):
         src = src.transpose(0, 1)  # transpose to have batch first
         tgt = tgt.transpose(0, 1)
 
-        encoder_output = self.encoder(src, input_pos=src_pos, input_lang=src_lang, streaming=streaming,
-                                      src_lengths=src_lengths, streaming_state=streaming_state)
-
-        encoder_output = defaultdict(lambda: None, encoder_output)
-        context = encoder_output['context']
-
-        # the state is changed
-        streaming_state = encoder_output['streaming_state']
-
-        # zero out the encoder part for pre-training
-        if zero_encoder:
-            context.zero_()
-
-        decoder_output = self.decoder(tgt, context, src,
-                                      src_lang=src_lang, tgt_lang=tgt_lang, input_pos=tgt_pos, streaming=streaming,
-                                      src_lengths=src_lengths, tgt_lengths=tgt_lengths,
-                                      streaming_state=streaming_state)
-
-        # update the streaming state again
-        decoder_output = defaultdict(lambda: None, decoder_output)
-        streaming_state = decoder_output['streaming_state']
-        output = decoder_output['hidden']
-
-        # build the output dict based on decoder output
-        output_dict = defaultdict(lambda: None, decoder_output)
-        output_dict['hidden'] = output
-        output_dict['context'] = context
-        output_dict['src_mask'] = encoder_output['src_mask']
-        output_dict['src'] = src
-        output_dict['target_mask'] = target_mask
-        output_dict['streaming_state'] = streaming_state
-        output_dict['target'] = batch.get('target_output')
-        # output_dict['lid_logits'] = decoder_output['lid_logits']
-
-        # final layer: computing softmax
-        if self.training and nce:
-            output_dict = self.generator[0](output_dict)
-        else:
-            logprobs = self.generator[0](output_dict)['logits']
-            output_dict['logprobs'] = logprobs
-
-        # Mirror network: reverse the target sequence and perform backward language model
-        if mirror:
-            # tgt_reverse = torch.flip(batch.get('target_input'), (0, ))
-            tgt_pos = torch.flip(batch.get('target_pos'), (0,))
-            tgt_reverse = torch.flip(batch.get('target'), (0,))
-            tgt_reverse_input = tgt_reverse[:-1]
-            tgt_reverse_output = tgt_reverse[1:]
-
-            tgt_reverse_input = tgt_reverse_input.transpose(0, 1)
-            # perform an additional backward pass
-            reverse_decoder_output = self.mirror_decoder(tgt_reverse_input, context, src, src_lang=src_lang,
-                                                         tgt_lang=tgt_lang, input_pos=tgt_pos)
-
-            reverse_decoder_output['src'] = src
-            reverse_decoder_output['context'] = context
-            reverse_decoder_output['target_mask'] = target_mask
-
-            reverse_logprobs = self.mirror_generator[0](reverse_decoder_output)['logits']
-
-            output_dict['reverse_target'] = tgt_reverse_output
-            output_dict['reverse_hidden'] = reverse_decoder_output['hidden']
-            output_dict['reverse_logprobs'] = reverse_logprobs
-            output_dict['target_input'] = batch.get('target_input')
-            output_dict['target_lengths'] = batch.tgt_lengths
-
-            # learn weights for mapping (g in the paper)
-            output_dict['hidden'] = self.mirror_g(output_dict['hidden'])
-
-        # Reconstruction network
-        if self.reconstruct:
-            bos = org_tgt[0].unsqueeze(0)  # 1 x B
-            src_input = torch.cat([bos, org_src[:-1]], dim=0)  # T x B
-            src_output = org_src
-
-            src_input = src_input.transpose(0, 1)
-            rec_context = self.rec_linear(output_dict['hidden'])  # T x B x H
-            rec_decoder_output = self.rec_decoder(src_input, rec_context, tgt, tgt_lang=src_lang, input_pos=src_pos)
-            rec_output = rec_decoder_output['hidden']
-            rec_logprobs = self.rec_generator[0](rec_decoder_output)['logits']
-
-            output_dict['rec_logprobs'] = rec_logprobs
-            output_dict['rec_hidden'] = rec_output
-            output_dict['reconstruct'] = True
-            output_dict['rec_target'] = src_output
-        else:
-            output_dict['reconstruct'] = False
+        # run the whole network (including the generators) in bfloat16 where it is safe,
+        # the softmax in the loss functions is computed in float32
+        with self.autocast(src.device):
+            encoder_output = self.encoder(src, input_pos=src_pos, input_lang=src_lang, streaming=streaming,
+                                          src_lengths=src_lengths, streaming_state=streaming_state,
+                                          src_size=batch.src_size)
+
+            encoder_output = defaultdict(lambda: None, encoder_output)
+            context = encoder_output['context']
+
+            # the state is changed
+            streaming_state = encoder_output['streaming_state']
+
+            # zero out the encoder part for pre-training
+            if zero_encoder:
+                context.zero_()
+
+            decoder_output = self.decoder(tgt, context, src,
+                                          src_lang=src_lang, tgt_lang=tgt_lang, input_pos=tgt_pos, streaming=streaming,
+                                          src_lengths=src_lengths, tgt_lengths=tgt_lengths,
+                                          streaming_state=streaming_state)
+
+            # update the streaming state again
+            decoder_output = defaultdict(lambda: None, decoder_output)
+            streaming_state = decoder_output['streaming_state']
+            output = decoder_output['hidden']
+
+            # build the output dict based on decoder output
+            output_dict = defaultdict(lambda: None, decoder_output)
+            output_dict['hidden'] = output
+            output_dict['context'] = context
+            output_dict['src_mask'] = encoder_output['src_mask']
+            output_dict['src'] = src
+            output_dict['target_mask'] = target_mask
+            output_dict['streaming_state'] = streaming_state
+            output_dict['target'] = batch.get('target_output')
+            # output_dict['lid_logits'] = decoder_output['lid_logits']
+
+            # final layer: computing softmax
+            if self.training and nce:
+                output_dict = self.generator[0](output_dict)
+            else:
+                logprobs = self.generator[0](output_dict)['logits']
+                output_dict['logprobs'] = logprobs
+
+            # Mirror network: reverse the target sequence and perform backward language model
+            if mirror:
+                # tgt_reverse = torch.flip(batch.get('target_input'), (0, ))
+                tgt_pos = torch.flip(batch.get('target_pos'), (0,))
+                tgt_reverse = torch.flip(batch.get('target'), (0,))
+                tgt_reverse_input = tgt_reverse[:-1]
+                tgt_reverse_output = tgt_reverse[1:]
+
+                tgt_reverse_input = tgt_reverse_input.transpose(0, 1)
+                # perform an additional backward pass
+                reverse_decoder_output = self.mirror_decoder(tgt_reverse_input, context, src, src_lang=src_lang,
+                                                             tgt_lang=tgt_lang, input_pos=tgt_pos)
+
+                reverse_decoder_output['src'] = src
+                reverse_decoder_output['context'] = context
+                reverse_decoder_output['target_mask'] = target_mask
+
+                reverse_logprobs = self.mirror_generator[0](reverse_decoder_output)['logits']
+
+                output_dict['reverse_target'] = tgt_reverse_output
+                output_dict['reverse_hidden'] = reverse_decoder_output['hidden']
+                output_dict['reverse_logprobs'] = reverse_logprobs
+                output_dict['target_input'] = batch.get('target_input')
+                output_dict['target_lengths'] = batch.tgt_lengths
+
+                # learn weights for mapping (g in the paper)
+                output_dict['hidden'] = self.mirror_g(output_dict['hidden'])
+
+            # Reconstruction network
+            if self.reconstruct:
+                bos = org_tgt[0].unsqueeze(0)  # 1 x B
+                src_input = torch.cat([bos, org_src[:-1]], dim=0)  # T x B
+                src_output = org_src
+
+                src_input = src_input.transpose(0, 1)
+                rec_context = self.rec_linear(output_dict['hidden'])  # T x B x H
+                rec_decoder_output = self.rec_decoder(src_input, rec_context, tgt, tgt_lang=src_lang, input_pos=src_pos)
+                rec_output = rec_decoder_output['hidden']
+                rec_logprobs = self.rec_generator[0](rec_decoder_output)['logits']
+
+                output_dict['rec_logprobs'] = rec_logprobs
+                output_dict['rec_hidden'] = rec_output
+                output_dict['reconstruct'] = True
+                output_dict['rec_target'] = src_output
+            else:
+                output_dict['reconstruct'] = False
 
-        # compute the logits for each encoder step
-        if self.ctc:
-            output_dict['encoder_logits'] = self.ctc_linear(output_dict['context'])
+            # compute the logits for each encoder step
+            if self.ctc:
+                output_dict['encoder_logits'] = self.ctc_linear(output_dict['context'])
 
-        return output_dict
+            return output_dict
 
     def decode(self, batch):
         """
@@ -988,5 +1098,4 @@ class TransformerDecodingState(DecoderState):
             buffer_ = self.attention_buffers[l]
             if buffer_ is not None:
                 for k in buffer_.keys():
-                    t_, br_, d_ = buffer_[k].size()
-                    buffer_[k] = buffer_[k].index_select(1, reorder_state)  # 1 for time first
+                    buffer_[k] = reorder_cache(buffer_[k], reorder_state)  # 1 for time first
@@ -29,8 +29,7 @@ class UnifiedTransformer(TransformerDecoder):
         # build_modules will be called from the inherited constructor
         super(UnifiedTransformer, self).__init__(opt, tgt_embedding,
                                                  positional_encoder,
-                                                 language_embeddings=language_embeddings,
-                                                 allocate_positions=True)
+                                                 language_embeddings=language_embeddings)
         self.src_embedding = src_embedding
         self.tgt_embedding = tgt_embedding
         # self.language_embedding = nn.Embedding(3, self.model_size, padding_idx=0)
@@ -74,8 +73,7 @@ class UnifiedTransformer(TransformerDecoder):
             # attn_mask = torch.gt(attn_mask, 0).bool()
 
         else:
-            attn_mask = self.mask[:seq_len, :seq_len] + input_seq.eq(onmt.constants.PAD).byte().unsqueeze(1)
-            attn_mask = torch.gt(attn_mask, 0).bool()
+            attn_mask = self.causal_mask(seq_len, input_seq.device) | input_seq.eq(onmt.constants.PAD).unsqueeze(1)
 
         return attn_mask
 
@@ -256,15 +254,6 @@ class UnifiedTransformer(TransformerDecoder):
 
         return gold_words, gold_scores, allgold_scores
 
-    def renew_buffer(self, new_len):
-
-        # This model uses pre-allocated position encoding
-        self.positional_encoder.renew(new_len)
-        mask = torch.ByteTensor(np.triu(np.ones((new_len + 1, new_len + 1)), k=1).astype('uint8'))
-        self.register_buffer('mask', mask)
-
-        return
-
     def reset_states(self):
         return
 
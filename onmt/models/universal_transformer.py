@@ -267,7 +267,6 @@ class UniversalTransformerDecoder(TransformerDecoder):
         else:
             input_ = input
         """ Embedding: batch_size x 1 x d_model """
-        check = input_.gt(self.word_lut.num_embeddings)
         emb = self.word_lut(input_)
 
         """ Adding positional encoding """
@@ -1,7 +1,6 @@
 import math
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
 import torch.nn.init as init
 import torch.nn.utils.weight_norm as WeightNorm
 import onmt
@@ -9,7 +8,12 @@ import torch.nn.functional as F
 from onmt.modules.bottle import Bottle
 from onmt.modules.static_dropout import StaticDropout
 from onmt.modules.linear import XavierLinear as Linear
-from onmt.modules.linear import group_linear
+from onmt.utils import append_to_cache
+
+try:
+    from flash_attn import flash_attn_varlen_func
+except (ModuleNotFoundError, ImportError) as e:
+    flash_attn_varlen_func = None
 
 
 class MultiHeadAttention(nn.Module):
@@ -33,7 +37,7 @@ class MultiHeadAttention(nn.Module):
 
     Outputs Shapes:
         out:      batch_size x len_query x d_model
-        coverage: batch_size x len_query x len_key
+        coverage: batch_size x len_query x len_key (None if need_weights is False)
 
     """
 
@@ -58,24 +62,47 @@ class MultiHeadAttention(nn.Module):
         else:
             self.attn_dropout = nn.Dropout(attn_p)
 
+        # the fused attention kernel cannot reuse a static dropout mask or return the attention weights
+        self.use_sdpa = hasattr(F, 'scaled_dot_product_attention') and not static
+
+        self._packed_weight_key = None
+        self._packed_weight = None
+
+    def packed_weight(self, linears):
+        """
+        Concatenate the projection weights so that the projections are done with one GEMM.
+        Without autograd (e.g. during decoding) the result is kept until one of the weights changes
+        """
+        weights = [linear.weight for linear in linears]
+        if torch.is_grad_enabled():
+            self._packed_weight_key, self._packed_weight = None, None
+            return torch.cat(weights, dim=0)
+
+        key = tuple((id(w), w.data_ptr(), w._version, w.dtype) for w in weights)
+        if key != self._packed_weight_key:
+            self._packed_weight = torch.cat(weights, dim=0)
+            self._packed_weight_key = key
+
+        return self._packed_weight
+
     def forward(self, query, key, value, mask,
-                incremental=False, incremental_cache=None):
+                incremental=False, incremental_cache=None, need_weights=True):
 
         len_query, b = query.size(0), query.size(1)
 
         # batch_size*h x len_query x d_head
         # project inputs to multi-heads
         if self.share == 1:
-            shared_qkv = group_linear(
-                [self.fc_query.function.linear, self.fc_key.function.linear, self.fc_value.function.linear], query)
+            shared_qkv = F.linear(query, self.packed_weight(
+                [self.fc_query.function.linear, self.fc_key.function.linear, self.fc_value.function.linear]))
             proj_query, proj_key, proj_value = shared_qkv.chunk(3, dim=-1)
 
             # In incremental case: we concatenate the previously computed (mapped) states to the proj_key and proj_v
             if incremental:
                 if 'k' in incremental_cache and 'v' in incremental_cache:
-                    proj_key = torch.cat([incremental_cache['k'], proj_key], dim=0)  # time first
+                    proj_key = append_to_cache(incremental_cache['k'], proj_key)  # time first
                     incremental_cache['k'] = proj_key
-                    proj_value = torch.cat([incremental_cache['v'], proj_value], dim=0)  # time first
+                    proj_value = append_to_cache(incremental_cache['v'], proj_value)  # time first
                     incremental_cache['v'] = proj_value
                     len_key, b_ = proj_key.size(0), proj_key.size(1)
                 else:
@@ -91,7 +118,8 @@ class MultiHeadAttention(nn.Module):
                 proj_key = incremental_cache['c_k']
                 proj_value = incremental_cache['c_v']
             else:
-                shared_kv = group_linear([self.fc_key.function.linear, self.fc_value.function.linear], key)
+                shared_kv = F.linear(key, self.packed_weight([self.fc_key.function.linear,
+                                                              self.fc_value.function.linear]))
                 proj_key, proj_value = shared_kv.chunk(2, dim=-1)
                 if incremental:
                     incremental_cache['c_k'] = proj_key
@@ -109,16 +137,31 @@ class MultiHeadAttention(nn.Module):
         k = k.contiguous().view(len_key, b * self.h, self.d_head).transpose(0, 1)
         v = v.contiguous().view(len_key, b * self.h, self.d_head).transpose(0, 1)
 
-        q = q * (self.d_head ** -0.5)
+        if not need_weights and self.use_sdpa and not onmt.constants.double_precision:
+            q = q.view(b, self.h, len_query, self.d_head)
+            k = k.view(b, self.h, len_key, self.d_head)
+            v = v.view(b, self.h, len_key, self.d_head)
+            # the fused kernel expects True for the positions that take part in attention
+            attn_mask = ~mask.unsqueeze(-3) if mask is not None else None
+            dropout_p = self.attn_dropout.p if self.training else 0.0
+
+            out = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask, dropout_p=dropout_p)
+            out = out.permute(2, 0, 1, 3).contiguous().view(len_query, b, self.d)
+
+            out = self.fc_concat(out)
+
+            return out, None
 
         # get dotproduct softmax attns for each head
-        attns = torch.bmm(q, k.transpose(1, 2))  # batch_size*h x len_query x len_key
+        # (the 1/sqrt(d_head) scaling is applied by the GEMM instead of a separate pass over q)
+        attns = torch.baddbmm(q.new_empty(q.size(0), len_query, len_key), q, k.transpose(1, 2),
+                              beta=0.0, alpha=self.d_head ** -0.5)  # batch_size*h x len_query x len_key
 
         attns = attns.view(b, self.h, len_query, len_key)
         if mask is not None:
             mask_ = mask.unsqueeze(-3)
-            # FP16 support: cast to float and back
-            attns = attns.float().masked_fill_(mask_, -float('inf')).type_as(attns)
+            # -inf is representable in fp16 and softmax below upcasts anyway, so the scores are masked in place
+            attns = attns.masked_fill_(mask_, -float('inf'))
 
         dtype_ = torch.float64 if onmt.constants.double_precision else torch.float32
         attns = F.softmax(attns, dim=-1, dtype=dtype_).type_as(attns)
@@ -134,3 +177,26 @@ class MultiHeadAttention(nn.Module):
         out = self.fc_concat(out)
 
         return out, coverage
+
+    def varlen_forward(self, input, cu_seqlens, max_seqlen):
+        """
+        Self-attention over sequences packed without padding (requires flash_attn and half/bfloat16 inputs)
+        :param input: total_len x 1 x d_model (the non-padded positions of all sequences, one after another)
+        :param cu_seqlens: (batch_size + 1) int32 tensor, the cumulative sequence lengths starting with 0
+        :param max_seqlen: the length of the longest sequence
+        :return: total_len x 1 x d_model, None
+        """
+        total_len = input.size(0)
+
+        qkv = F.linear(input, self.packed_weight(
+            [self.fc_query.function.linear, self.fc_key.function.linear, self.fc_value.function.linear]))
+        q, k, v = qkv.view(total_len, 3, self.h, self.d_head).unbind(dim=1)
+
+        dropout_p = self.attn_dropout.p if self.training else 0.0
+        out = flash_attn_varlen_func(q, k, v, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen,
+                                     dropout_p=dropout_p, softmax_scale=self.d_head ** -0.5)
+        out = out.reshape(total_len, 1, self.d)
+
+        out = self.fc_concat(out)
+
+        return out, None
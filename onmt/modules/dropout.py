@@ -1,6 +1,5 @@
 import numpy as np
 import torch
-from torch.autograd import Variable
 import torch.nn.functional as F
 import onmt
 
@@ -89,7 +88,7 @@ def switchout(words, vocab_size, tau=1.0, transpose=False, offset=0):
 
     mask = torch.eq(words, onmt.constants.BOS) | \
            torch.eq(words, onmt.constants.EOS) | torch.eq(words, onmt.constants.PAD)
-    lengths = (1 - mask.byte()).float().sum(dim=1)
+    lengths = (~mask).sum(dim=1).float()
     batch_size, n_steps = words.size()
 
     # first, sample the number of words to corrupt for each sent in batch
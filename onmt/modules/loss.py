@@ -27,6 +27,27 @@ def tiny_value_of_dtype(dtype: torch.dtype):
         raise TypeError("Does not support dtype " + str(dtype))
 
 
+def label_smoothed_nll(logits, gtruth, padding_idx, label_smoothing, eps_i):
+    """
+    Summed (label smoothed) negative log likelihood of the non-padded targets
+    :param logits: N x V tensor
+    :param gtruth: N tensor of target indices
+    """
+    lprobs = F.log_softmax(logits, dim=-1, dtype=torch.float32)
+
+    # padded positions are zeroed instead of selected with a boolean index,
+    # which would need a device sync to find the number of selected rows
+    pad_mask = gtruth.eq(padding_idx)
+    loss = -lprobs.gather(1, gtruth.unsqueeze(1)).squeeze(1)
+
+    # the sum over the vocabulary is only needed for label smoothing
+    if eps_i > 0:
+        smooth_loss = -lprobs.sum(dim=-1)
+        loss = (1. - label_smoothing) * loss + eps_i * smooth_loss
+
+    return loss.masked_fill_(pad_mask, 0).sum()
+
+
 class CrossEntropyLossBase(_Loss):
     """
     Class for managing efficient loss computation.
@@ -59,6 +80,19 @@ class CrossEntropyLossBase(_Loss):
         else:
             self.softmax_xentropy = None
 
+        self._label_smoothed_nll = label_smoothed_nll
+
+    def compile_loss(self):
+        """
+        Compile the (non fused) cross entropy with torch.compile, so that the log-softmax, label smoothing
+        and padding mask over the B*T x V logits run in a few fused kernels
+        """
+        if self.fast_xentropy or not hasattr(torch, 'compile'):
+            return
+
+        # the number of target tokens changes from batch to batch
+        self._label_smoothed_nll = torch.compile(label_smoothed_nll, dynamic=True)
+
     def _compute_loss(self, logits, targets, vocab_mask=None):
         """
         :param logits: T x B x V or B x T x V tensor (output of decoder)
@@ -81,17 +115,12 @@ class CrossEntropyLossBase(_Loss):
         eps_i = self.smoothing_value if self.training else 0.0
 
         if not self.fast_xentropy:
-            lprobs = F.log_softmax(logits, dim=-1, dtype=torch.float32)
-
-            non_pad_mask = gtruth.ne(self.padding_idx)
-            nll_loss = -lprobs.gather(1, gtruth.unsqueeze(1))[non_pad_mask]
-            smooth_loss = -lprobs.sum(dim=-1, keepdim=True)[non_pad_mask]
-            nll_loss = nll_loss.sum()
-            smooth_loss = smooth_loss.sum()
-
-            loss = (1. - label_smoothing) * nll_loss + eps_i * smooth_loss
+            loss = self._label_smoothed_nll(logits, gtruth, self.padding_idx, label_smoothing, eps_i)
             loss_data = loss.data.item()
         else:
+            # the fused kernel only supports half and float logits
+            if logits.dtype == torch.bfloat16:
+                logits = logits.float()
             half_to_float = (logits.dtype == torch.half)
             loss = self.softmax_xentropy(logits, gtruth, label_smoothing, self.padding_idx, half_to_float)
             loss = loss.sum()
@@ -1,6 +1,7 @@
 import torch
 import torch.nn.functional as F
 from onmt.constants import double_precision
+from onmt.utils import append_to_cache
 
 try:
     import apex.amp as amp
@@ -55,9 +56,9 @@ class SelfAttnFunc(torch.autograd.Function):
             keys = keys.contiguous().view(len_q, bsz, heads * head_dim)
             values = values.contiguous().view(len_q, bsz, heads * head_dim)
             if 'k' in incremental_cache and 'v' in incremental_cache:
-                keys = torch.cat([incremental_cache['k'], keys], dim=0)  # time first
+                keys = append_to_cache(incremental_cache['k'], keys)  # time first
                 incremental_cache['k'] = keys
-                values = torch.cat([incremental_cache['v'], values], dim=0)  # time first
+                values = append_to_cache(incremental_cache['v'], values)  # time first
                 incremental_cache['v'] = values
             else:
                 incremental_cache['k'] = keys
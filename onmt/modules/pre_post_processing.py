@@ -1,5 +1,6 @@
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 from .layer_norm import LayerNorm, MultilingualLayerNorm
 import onmt
 from onmt.modules.dropout import VariationalDropout
@@ -26,7 +27,9 @@ class PrePostProcessing(nn.Module):
 
         self.steps = list(sequence)
 
-        if onmt.constants.residual_type == 'gated':
+        # the residual type is set globally before the model is built, so it is only read once here
+        self.gated_residual = onmt.constants.residual_type == 'gated'
+        if self.gated_residual:
             # gated residual
             # initialize k with one
             self.k = nn.Parameter(torch.ones(1))
@@ -61,15 +64,15 @@ class PrePostProcessing(nn.Module):
 
                     # maybe we don't need to do "type_as" anymore after using amp.half_function at layer norm
                     output = self.layer_norm(output, factor)
-                    output = output
                 else:
                     output = self.layer_norm(output.type_as(self.layer_norm.function.weight))
             if step == 'd':
                 output = self.dropout(output)
             if step == 'a':
                 if input_tensor is not None:
-                    if onmt.constants.residual_type != 'gated':
+                    if not self.gated_residual:
                         output = output + input_tensor
                     else:
-                        output = F.relu(self.k) * output + input_tensor
+                        # input + relu(k) * output in one kernel, without the intermediate scaled tensor
+                        output = torch.addcmul(input_tensor, output, F.relu(self.k))
         return output
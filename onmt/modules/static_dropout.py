@@ -1,6 +1,5 @@
 import torch
 from torch.autograd.function import InplaceFunction, Function
-from torch.autograd import Variable
 from itertools import repeat
 import torch.nn as nn
 
@@ -17,7 +16,8 @@ class StaticDropoutFunction(Function):
         if ctx.p == 0 or not ctx.train:
             return input
             
-        if torch.numel(module.noise) != torch.numel(input):
+        # the mask is reused for the whole forward pass, as long as the shape matches
+        if module.noise is None or module.noise.size() != input.size():
             module.gen_noise(input)
             
             
@@ -45,15 +45,15 @@ class StaticDropout(nn.Module):
             raise ValueError("dropout probability has to be between 0 and 1, "
                              "but got {}".format(p))
         self.p = p
+        self.noise = None
         self.noise_created = False
     
     def gen_noise(self, input):
-        self.noise = input.new().resize_as_(input)
+        # sample and scale the mask in place on a single allocation
         if self.p == 1:
-            self.noise.fill_(0)
+            self.noise = torch.zeros_like(input)
         else:
-            self.noise.bernoulli_(1 - self.p).div_(1 - self.p)
-        self.noise = self.noise.expand_as(input)
+            self.noise = torch.empty_like(input).bernoulli_(1 - self.p).div_(1 - self.p)
         self.noise_created = True
 
     def forward(self, input):
@@ -2,6 +2,7 @@ import math
 import torch
 import torch.optim as optim
 from torch.optim.optimizer import Optimizer
+from onmt.utils import normalize_gradients
 # try:
 #     from apex.multi_tensor_apply import multi_tensor_applier
 # except ModuleNotFoundError as e:
@@ -309,21 +310,14 @@ from torch.optim.optimizer import Optimizer
 #         return loss
 
 
-def normalize_gradients(parameters, denom):
-    """ early return if no need to normalize """
-    if denom == 1:
-        return
-
-    parameters = list(filter(lambda p: p.grad is not None, parameters))
-
-    denom = float(denom)
-
-    for p in parameters:
-        p.grad.data.div_(denom)
-
-
 def detech_nan_inf(parameters):
     parameters = list(filter(lambda p: p.grad is not None, parameters))
+    grads = [p.grad for p in parameters]
+
+    if hasattr(torch, '_foreach_norm') and not any(g.is_sparse for g in grads) and len(grads) > 0:
+        # one multi-tensor max-norm (which cannot overflow) and one synchronization for all gradients
+        norms = torch._foreach_norm(grads, float('inf'))
+        return not bool(torch.isfinite(torch.stack(norms)).all())
 
     for p in parameters:
         if torch.isinf(p.grad.data).any() or torch.isnan(p.grad.data).any():
@@ -18,7 +18,7 @@ from onmt.data.dataset import rewrap
 from onmt.model_factory import build_model, build_language_model, optimize_model
 from onmt.model_factory import init_model_parameters
 from onmt.train_utils.stats import Logger
-from onmt.utils import checkpoint_paths, normalize_gradients
+from onmt.utils import checkpoint_paths, normalize_and_clip_gradients
 from .trainer import BaseTrainer
 
 
@@ -449,10 +449,9 @@ class BayesianTrainer(BaseTrainer):
                     else:
                         grad_denom = 1
                     # When we accumulate the gradients, each gradient is already normalized by a constant grad_scaler
-                    normalize_gradients(amp.master_params(optimizer), grad_denom)
+                    # normalizing and clipping are fused into one pass over the gradients
+                    normalize_and_clip_gradients(amp.master_params(optimizer), grad_denom, self.opt.max_grad_norm)
                     # Update the parameters.
-                    if self.opt.max_grad_norm > 0:
-                        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.opt.max_grad_norm)
                     self.optim.step()
                     self.optim.zero_grad()
                     self.model.zero_grad()
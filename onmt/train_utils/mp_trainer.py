@@ -270,9 +270,13 @@ class Trainer(object):
             # any particular graph)
             find_unused_parameters = True if opt.death_rate > 0.0 else True
 
+            # the gradients are views into the (25MB) all-reduce buckets, which are reduced while the backward
+            # pass of the preceding layers is still running: no separate gradient and bucket copies
             self.model = torch.nn.parallel.DistributedDataParallel(self.model, device_ids=[self.rank],
                                                                    output_device=self.rank,
-                                                                   find_unused_parameters=find_unused_parameters)
+                                                                   find_unused_parameters=find_unused_parameters,
+                                                                   bucket_cap_mb=25,
+                                                                   gradient_as_bucket_view=True)
 
         print("[INFO] Process %d ready." % self.rank, flush=True)
 
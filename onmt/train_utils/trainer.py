@@ -1,5 +1,6 @@
 from __future__ import division
 
+import contextlib
 import datetime
 import gc
 import inspect
@@ -8,6 +9,7 @@ import os
 import re
 import time
 import torch
+from concurrent.futures import ThreadPoolExecutor
 from apex import amp
 
 import onmt
@@ -19,7 +21,8 @@ from onmt.data.dataset import rewrap
 from onmt.model_factory import build_model, build_language_model, optimize_model
 from onmt.model_factory import init_model_parameters
 from onmt.train_utils.stats import Logger
-from onmt.utils import checkpoint_paths, normalize_gradients
+from onmt.utils import checkpoint_paths, normalize_gradients, normalize_and_clip_gradients, copy_to_cpu
+from onmt.utils import load_checkpoint_mmap, assign_state_dict
 
 from onmt.multiprocessing.multiprocessing_wrapper import MultiprocessingRunner
 
@@ -31,17 +34,19 @@ def varname(p):
             return m.group(1)
 
 
-def generate_data_iterator(dataset, seed, num_workers=1, epoch=1., buffer_size=0):
+def generate_data_iterator(dataset, seed, num_workers=1, epoch=1., buffer_size=0, persistent_workers=False):
 
     # check if dataset is a list:
     if isinstance(dataset, list):
         # this is a multidataset
         data_iterator = MultiDataIterator(dataset, seed=seed, num_workers=num_workers,
-                                          epoch=epoch, buffer_size=buffer_size)
+                                          epoch=epoch, buffer_size=buffer_size,
+                                          persistent_workers=persistent_workers)
     else:
 
         data_iterator = DataIterator(dataset, dataset.collater, dataset.batches, seed=seed,
-                                     num_workers=num_workers, epoch=epoch, buffer_size=buffer_size)
+                                     num_workers=num_workers, epoch=epoch, buffer_size=buffer_size,
+                                     persistent_workers=persistent_workers)
 
     return data_iterator
 
@@ -72,10 +77,11 @@ class BaseTrainer(object):
     def load_encoder_weight(self, checkpoint_file):
 
         print("Loading pretrained models from %s" % checkpoint_file)
-        checkpoint = torch.load(checkpoint_file, map_location=lambda storage, loc: storage)
+        checkpoint = load_checkpoint_mmap(checkpoint_file)
 
+        # the pretrained model takes over the mapped tensors: only the encoder weights are read from disk
         pretrained_model = build_model(checkpoint['opt'], checkpoint['dicts'])
-        pretrained_model.load_state_dict(checkpoint['model'])
+        assign_state_dict(pretrained_model, checkpoint['model'])
 
         print("Loading pretrained encoder weights ...")
         pretrained_model.encoder.language_embedding = None
@@ -90,11 +96,12 @@ class BaseTrainer(object):
     def load_decoder_weight(self, checkpoint_file):
 
         print("Loading pretrained models from %s" % checkpoint_file)
-        checkpoint = torch.load(checkpoint_file, map_location=lambda storage, loc: storage)
+        checkpoint = load_checkpoint_mmap(checkpoint_file)
         chkpoint_dict = checkpoint['dicts']
 
+        # the pretrained model takes over the mapped tensors: only the decoder weights are read from disk
         pretrained_model = build_model(checkpoint['opt'], chkpoint_dict)
-        pretrained_model.load_state_dict(checkpoint['model'])
+        assign_state_dict(pretrained_model, checkpoint['model'])
 
         print("Loading pretrained decoder weights ...")
         # first we have to remove the embeddings which probably have difference size ...
@@ -113,31 +120,36 @@ class BaseTrainer(object):
         self.model.decoder.load_state_dict(decoder_state_dict)
 
         # now we load the embeddings ....
-        n_copies = 0
-        for token in self.dicts['tgt'].labelToIdx:
-
-            untrained_id = self.dicts['tgt'].labelToIdx[token]
-
-            if token in chkpoint_dict['tgt'].labelToIdx:
-                pretrained_id = chkpoint_dict['tgt'].labelToIdx[token]
-                untrained_word_emb.weight.data[untrained_id].copy_(pretrained_word_emb.weight.data[pretrained_id])
-
-                self.model.generator[0].linear.bias.data[untrained_id].copy_(pretrained_model
-                                                                             .generator[0].linear.bias.data[
-                                                                                 pretrained_id])
-                n_copies += 1
+        # the rows of the shared tokens are gathered and scattered with one kernel each
+        tgt_vocab = self.dicts['tgt'].labelToIdx
+        pretrained_vocab = chkpoint_dict['tgt'].labelToIdx
+        # (the order of the set does not matter, the two index lists are built from the same sequence)
+        shared_tokens = list(tgt_vocab.keys() & pretrained_vocab.keys())
+
+        def copy_rows(untrained, pretrained, untrained_vocab, pretrained_vocab, keys):
+            untrained_ids = torch.LongTensor([untrained_vocab[key] for key in keys])
+            pretrained_ids = torch.LongTensor([pretrained_vocab[key] for key in keys])
+            rows = pretrained.index_select(0, pretrained_ids.to(pretrained.device))
+            untrained.index_copy_(0, untrained_ids.to(untrained.device), rows.to(untrained))
+
+        if len(shared_tokens) > 0:
+            with torch.no_grad():
+                copy_rows(untrained_word_emb.weight, pretrained_word_emb.weight,
+                          tgt_vocab, pretrained_vocab, shared_tokens)
+                copy_rows(self.model.generator[0].linear.bias, pretrained_model.generator[0].linear.bias,
+                          tgt_vocab, pretrained_vocab, shared_tokens)
+        n_copies = len(shared_tokens)
 
         print("Copied embedding for %d words" % n_copies)
         self.model.decoder.word_lut = untrained_word_emb
 
         # now we load the language embeddings ...
         if pretrained_lang_emb and untrained_lang_emb and 'langs' in chkpoint_dict:
-            for lang in self.dicts['langs']:
-
-                untrained_id = self.dicts['langs'][lang]
-                if lang in chkpoint_dict['langs']:
-                    pretrained_id = chkpoint_dict['langs'][lang]
-                    untrained_lang_emb.weight.data[untrained_id].copy_(pretrained_lang_emb.weight.data[pretrained_id])
+            shared_langs = list(self.dicts['langs'].keys() & chkpoint_dict['langs'].keys())
+            if len(shared_langs) > 0:
+                with torch.no_grad():
+                    copy_rows(untrained_lang_emb.weight, pretrained_lang_emb.weight,
+                              self.dicts['langs'], chkpoint_dict['langs'], shared_langs)
 
         self.model.decoder.language_embeddings = untrained_lang_emb
 
@@ -155,6 +167,17 @@ class BaseTrainer(object):
             grads.append(p.grad.data)
         return grads
 
+    def _maybe_no_sync(self, sync):
+        """
+        Skip the gradient all-reduce of a DistributedDataParallel model in backward passes that only
+        accumulate gradients, so that it runs once (bucketed) before the update.
+        No-op for models without no_sync (single GPU)
+        """
+        if not sync and hasattr(self.model, 'no_sync'):
+            return self.model.no_sync()
+
+        return contextlib.nullcontext()
+
     def _get_flat_grads(self, out=None):
         grads = self._get_grads()
         if out is None:
@@ -294,6 +317,13 @@ class XETrainer(BaseTrainer):
     def __init__(self, model, loss_function, train_data, valid_data, dicts, opt, setup_optimizer=True):
         super().__init__(model, loss_function, train_data, valid_data, dicts, opt)
 
+        # side stream for the host to device copies of the training batches (needs pinned memory)
+        self._copy_stream = torch.cuda.Stream() if self.cuda and opt.pin_memory else None
+
+        # checkpoints are written by a background thread
+        self._save_executor = ThreadPoolExecutor(max_workers=1)
+        self._save_future = None
+
         if opt.lfv_multilingual:
             from onmt.models.speech_recognizer.lid_loss import CrossEntropyLIDLoss
             lid_loss = CrossEntropyLIDLoss(opt.n_languages, opt.label_smoothing, opt.fast_xentropy)
@@ -314,27 +344,44 @@ class XETrainer(BaseTrainer):
             if opt.ctc_loss > 0.0:
                 self.ctc_loss_function = self.ctc_loss_function.cuda()
 
+        # the layers are compiled by the model factory, the loss computation is compiled here
+        if opt.torch_compile and hasattr(self.loss_function, 'compile_loss'):
+            self.loss_function.compile_loss()
+
         if setup_optimizer:
 
             self.optim = onmt.Optim(opt)
             self.optim.set_parameters(self.model.parameters())
 
+            master_weights = None
             if not self.opt.fp16:
                 opt_level = "O0"
                 keep_batchnorm_fp32 = False
             elif self.opt.fp16_mixed:
                 opt_level = "O1"
                 keep_batchnorm_fp32 = None
+            elif self.opt.memory_efficient_fp16:
+                # fp16 weights without the fp32 master copy
+                # the optimizer states are allocated like the (fp16) parameters
+                opt_level = "O2"
+                keep_batchnorm_fp32 = True
+                master_weights = False
             else:
                 opt_level = "O2"
                 keep_batchnorm_fp32 = False
 
+            # apex cannot unscale sparse gradients (sparse embeddings are only built without fp16 anyways)
+            # small vocabularies keep dense embeddings even with -sparse_embedding, so the built model is checked
+            sparse_embedding = any(m.sparse for m in self.model.modules() if isinstance(m, torch.nn.Embedding))
+            loss_scale = 1.0 if sparse_embedding else "dynamic"
+
             if self.cuda:
                 self.model, self.optim.optimizer = amp.initialize(self.model,
                                                                   self.optim.optimizer,
                                                                   opt_level=opt_level,
                                                                   keep_batchnorm_fp32=keep_batchnorm_fp32,
-                                                                  loss_scale="dynamic",
+                                                                  master_weights=master_weights,
+                                                                  loss_scale=loss_scale,
                                                                   verbosity=1 if self.opt.verbose else 0)
         # An ugly hack to switch between align right and align left
         if hasattr(self.model, 'relative'):
@@ -344,14 +391,48 @@ class XETrainer(BaseTrainer):
                 self.valid_data.src_align_right = True
                 self.valid_data.tgt_align_right = False
 
+    def _fetch_batch(self, epoch_iterator):
+        """
+        Get the next batch and start its copy to the GPU.
+        With pinned memory the copy is issued on a side stream, so that it overlaps with
+        the computation of the previous step that is still running on the GPU
+        """
+        batch = next(epoch_iterator)
+        if isinstance(batch, list) and self.n_gpus == 1:
+            batch = batch[0]
+        batch = rewrap(batch)
+
+        if self.cuda:
+            fp16 = self.opt.fp16 and not self.opt.fp16_mixed
+            if self._copy_stream is not None:
+                with torch.cuda.stream(self._copy_stream):
+                    batch.cuda(fp16=fp16, non_blocking=True)
+            else:
+                batch.cuda(fp16=fp16)
+
+        return batch
+
+    def _wait_for_batch(self, batch):
+        """
+        Make the compute stream wait for the copy of the batch started in _fetch_batch
+        """
+        if self._copy_stream is not None:
+            current_stream = torch.cuda.current_stream()
+            current_stream.wait_stream(self._copy_stream)
+            batch.record_stream(current_stream)
+
     def save(self, epoch, valid_ppl, itr=None):
 
         opt = self.opt
         model = self.model
         dicts = self.dicts
 
-        model_state_dict = self.model.state_dict()
-        optim_state_dict = self.optim.state_dict()
+        # only one checkpoint is in flight at any time (this also reports errors from the previous one)
+        self.wait_for_save()
+
+        # the state dicts reference the live parameters, so they are copied to the CPU first
+        model_state_dict = copy_to_cpu(self.model.state_dict())
+        optim_state_dict = copy_to_cpu(self.optim.state_dict())
 
         if itr:
             itr_state_dict = itr.state_dict()
@@ -369,8 +450,16 @@ class XETrainer(BaseTrainer):
             'amp': amp.state_dict()
         }
 
+        if self.cuda:
+            torch.cuda.synchronize()
+
         file_name = '%s_ppl_%.6f_e%.2f.pt' % (opt.save_model, valid_ppl, epoch)
         print('Writing to %s' % file_name)
+        self._save_future = self._save_executor.submit(self._write_checkpoint, checkpoint, file_name)
+
+    def _write_checkpoint(self, checkpoint, file_name):
+
+        opt = self.opt
         torch.save(checkpoint, file_name)
 
         # check the save directory here
@@ -380,6 +469,14 @@ class XETrainer(BaseTrainer):
             print(" * Deleting old save file %s ...." % save_file)
             os.remove(save_file)
 
+    def wait_for_save(self):
+        """
+        Block until the last checkpoint is written
+        """
+        if self._save_future is not None:
+            self._save_future.result()
+            self._save_future = None
+
     def eval(self, data):
         total_loss = 0
         total_words = 0
@@ -421,7 +518,7 @@ class XETrainer(BaseTrainer):
                         prob distribution from decoder generator
                 """
                 targets = batch.get('target_output')
-                tgt_mask = targets.ne(onmt.constants.PAD)
+                tgt_mask = batch.get('tgt_mask')
                 outputs = self.model(batch, streaming=opt.streaming, target_mask=tgt_mask,
                                      mirror=opt.mirror_loss, streaming_state=streaming_state, nce=opt.nce)
 
@@ -443,7 +540,7 @@ class XETrainer(BaseTrainer):
         self.loss_function.train()
         return total_loss / total_words
 
-    def train_epoch(self, epoch, resume=False, itr_progress=None):
+    def train_epoch(self, epoch, resume=False, itr_progress=None, data_iterator=None):
 
         global rec_ppl
         opt = self.opt
@@ -462,8 +559,11 @@ class XETrainer(BaseTrainer):
         # data iterator: object that controls the
         # data_iterator = DataIterator(dataset, dataset.collater, dataset.batches, seed=self.opt.seed,
         #                              num_workers=opt.num_workers, epoch=epoch, buffer_size=opt.buffer_size)
-        data_iterator = generate_data_iterator(dataset, seed=self.opt.seed, num_workers=opt.num_workers,
-                                               epoch=epoch, buffer_size=opt.buffer_size)
+        if data_iterator is None:
+            data_iterator = generate_data_iterator(dataset, seed=self.opt.seed, num_workers=opt.num_workers,
+                                                   epoch=epoch, buffer_size=opt.buffer_size)
+        else:
+            data_iterator.set_epoch(epoch)
 
         if resume:
             data_iterator.load_state_dict(itr_progress)
@@ -482,7 +582,6 @@ class XETrainer(BaseTrainer):
         counter = 0
         num_accumulated_words = 0
         num_accumulated_sents = 0
-        grad_scaler = 1
 
         nan = False
         nan_counter = 0
@@ -494,18 +593,17 @@ class XETrainer(BaseTrainer):
 
         i = data_iterator.iterations_in_epoch if not isinstance(train_data, list) else epoch_iterator.n_yielded
 
-        while not data_iterator.end_of_epoch():
+        # the step index (modulo log_interval) at which the statistics are printed
+        log_step = -1 % opt.log_interval
 
-            curriculum = (epoch < opt.curriculum)
+        # the next batch is fetched at the end of each step (after a possible checkpoint of the iterator state)
+        batch = self._fetch_batch(epoch_iterator) if not data_iterator.end_of_epoch() else None
 
-            # this batch generator is not very clean atm
-            batch = next(epoch_iterator)
-            if isinstance(batch, list) and self.n_gpus == 1:
-                batch = batch[0]
-            batch = rewrap(batch)
+        while batch is not None:
 
-            if self.cuda:
-                batch.cuda(fp16=self.opt.fp16 and not self.opt.fp16_mixed)
+            curriculum = (epoch < opt.curriculum)
+
+            self._wait_for_batch(batch)
 
             # if opt.streaming:
             #     if train_data.is_new_stream():
@@ -518,7 +616,7 @@ class XETrainer(BaseTrainer):
                 # outputs is a dictionary containing keys/values necessary for loss function
                 # can be flexibly controlled within models for easier extensibility
                 targets = batch.get('target_output')
-                tgt_mask = targets.ne(onmt.constants.PAD)
+                tgt_mask = batch.get('tgt_mask')
                 outputs = self.model(batch, streaming=opt.streaming, target_mask=tgt_mask,
                                      zero_encoder=opt.zero_encoder,
                                      mirror=opt.mirror_loss, streaming_state=streaming_state,
@@ -533,9 +631,10 @@ class XETrainer(BaseTrainer):
                 loss = loss_dict['loss']  # a little trick to avoid gradient overflow with fp16
                 full_loss = loss
 
+                # the auxiliary losses are accumulated as device tensors and only read when logging
                 if opt.ctc_loss > 0.0:
                     ctc_loss = self.ctc_loss_function(outputs, targets)
-                    ctc_loss_data = ctc_loss.item()
+                    ctc_loss_data = ctc_loss.detach()
                     full_loss = full_loss + opt.ctc_loss * ctc_loss
                     report_ctc_loss += ctc_loss_data
 
@@ -544,7 +643,7 @@ class XETrainer(BaseTrainer):
                     rev_loss_data = loss_dict['rev_loss_data']
                     mirror_loss = loss_dict['mirror_loss']
                     full_loss = full_loss + rev_loss + mirror_loss
-                    mirror_loss_data = loss_dict['mirror_loss'].item()
+                    mirror_loss_data = loss_dict['mirror_loss'].detach()
                 else:
                     rev_loss_data = None
                     mirror_loss_data = 0
@@ -567,15 +666,19 @@ class XETrainer(BaseTrainer):
 
                 optimizer = self.optim.optimizer
 
-                # When the batch size is large, each gradient step is very easy to explode on fp16
-                # Normalizing the loss to grad scaler ensures this will not happen
-                full_loss.div_(grad_scaler)
+                # the loss is not divided here: the normalization is applied once to the accumulated gradients
+                # before the update (grad_denom), and the dynamic loss scaler of amp prevents fp16 overflow
 
-                if self.cuda:
-                    with amp.scale_loss(full_loss, optimizer) as scaled_loss:
-                        scaled_loss.backward()
-                else:
-                    full_loss.backward()
+                # the same conditions as update_flag below, known before the backward pass
+                will_update = counter + 1 >= opt.update_frequency > 0 or \
+                    0 < opt.batch_size_update <= num_accumulated_words + batch.tgt_size or i == n_samples
+
+                with self._maybe_no_sync(will_update):
+                    if self.cuda:
+                        with amp.scale_loss(full_loss, optimizer) as scaled_loss:
+                            scaled_loss.backward()
+                    else:
+                        full_loss.backward()
 
                 del outputs
 
@@ -584,13 +687,14 @@ class XETrainer(BaseTrainer):
                     print('| WARNING: ran out of memory on GPU , skipping batch')
                     oom = True
                     torch.cuda.empty_cache()
-                    loss = 0
+                    loss, loss_data = 0, 0
                     if opt.streaming:  # reset stream in this case ...
                         streaming_state = self.model.init_stream()
                 else:
                     raise e
 
-            if loss != loss:
+            # loss_data is already a python float, checking it does not need another synchronization
+            if loss_data != loss_data:
                 # catching NAN problem
                 oom = True
                 self.model.zero_grad()
@@ -624,14 +728,12 @@ class XETrainer(BaseTrainer):
 
                 if update_flag:
                     # accumulated gradient case, in this case the update frequency
-                    grad_denom = 1 / grad_scaler
+                    grad_denom = 1.0
                     if self.opt.normalize_gradient:
-                        grad_denom = num_accumulated_words * grad_denom
-                    # When we accumulate the gradients, each gradient is already normalized by a constant grad_scaler
-                    normalize_gradients(amp.master_params(optimizer), grad_denom)
+                        grad_denom = num_accumulated_words
+                    # normalizing and clipping are fused into one pass over the gradients
+                    normalize_and_clip_gradients(amp.master_params(optimizer), grad_denom, self.opt.max_grad_norm)
                     # Update the parameters.
-                    if self.opt.max_grad_norm > 0:
-                        torch.nn.utils.clip_grad_norm_(amp.master_params(optimizer), self.opt.max_grad_norm)
                     self.optim.step()
                     self.optim.zero_grad()
                     self.model.zero_grad()
@@ -654,10 +756,9 @@ class XETrainer(BaseTrainer):
                 report_src_words += src_size
                 total_loss += loss_data
                 total_words += num_words
-                total_tokens += batch.get('target_output').nelement()
-                total_non_pads += batch.get('target_output').ne(onmt.constants.PAD).sum().item()
-                optim = self.optim
-                batch_efficiency = total_non_pads / total_tokens
+                total_tokens += targets.nelement()
+                # the non-padded target tokens are already counted by the collater (tgt_size)
+                total_non_pads += num_words
 
                 if opt.reconstruct:
                     report_rec_loss += rec_loss_data
@@ -666,7 +767,11 @@ class XETrainer(BaseTrainer):
                     report_rev_loss += rev_loss_data
                     report_mirror_loss += mirror_loss_data
 
-                if i == 0 or (i % opt.log_interval == -1 % opt.log_interval):
+                if i == 0 or i % opt.log_interval == log_step:
+                    optim = self.optim
+                    batch_efficiency = total_non_pads / total_tokens
+                    now = time.time()
+
                     log_string = ("Epoch %2d, %5d/%5d; ; ppl: %6.2f ; " %
                                   (epoch, i + 1, len(data_iterator),
                                    math.exp(report_loss / report_tgt_words)))
@@ -679,25 +784,25 @@ class XETrainer(BaseTrainer):
                         rev_ppl = math.exp(report_rev_loss / report_tgt_words)
                         log_string += (" rev_ppl: %6.2f ; " % rev_ppl)
                         # mirror loss per word
-                        log_string += (" mir_loss: %6.2f ; " % (report_mirror_loss / report_tgt_words))
+                        log_string += (" mir_loss: %6.2f ; " % (float(report_mirror_loss) / report_tgt_words))
 
                     log_string += ("lr: %.7f ; updates: %7d; " %
                                    (optim.getLearningRate(),
                                     optim._step))
 
                     log_string += ("%5.0f src tok/s; %5.0f tgt tok/s; " %
-                                   (report_src_words / (time.time() - start),
-                                    report_tgt_words / (time.time() - start)))
+                                   (report_src_words / (now - start),
+                                    report_tgt_words / (now - start)))
 
                     if opt.ctc_loss > 0.0:
                         # if torch.isinf(report_ctc_loss):
                         #     report_ctc_loss.zero_()
                         # dist.all_reduce(report_ctc_loss, op=dist.ReduceOp.SUM, group=self.group)
-                        ctc_loss = report_ctc_loss / report_tgt_words
+                        ctc_loss = float(report_ctc_loss) / report_tgt_words
                         log_string += (" ctcloss: %8.2f ; " % ctc_loss)
 
                     log_string += ("%s elapsed" %
-                                   str(datetime.timedelta(seconds=int(time.time() - self.start_time))))
+                                   str(datetime.timedelta(seconds=int(now - self.start_time))))
 
                     print(log_string)
 
@@ -705,10 +810,12 @@ class XETrainer(BaseTrainer):
                     report_tgt_words, report_src_words = 0, 0
                     report_rec_loss, report_rev_loss, report_mirror_loss = 0, 0, 0
                     report_ctc_loss = 0
-                    start = time.time()
+                    start = now
 
                 i = i + 1
 
+            batch = self._fetch_batch(epoch_iterator) if not data_iterator.end_of_epoch() else None
+
         return total_loss / total_words
 
     # def run(self, save_file=None):
@@ -728,7 +835,8 @@ class XETrainer(BaseTrainer):
                 if prec_opt is not None and hasattr(prec_opt, "fp16_mixed"):
                     # Only load amp information if the mode is the same
                     # Maybe its better to change between optimization mode?
-                    if opt.fp16_mixed == prec_opt.fp16_mixed and opt.fp16 == prec_opt.fp16:
+                    if opt.fp16_mixed == prec_opt.fp16_mixed and opt.fp16 == prec_opt.fp16 and \
+                            opt.memory_efficient_fp16 == getattr(prec_opt, 'memory_efficient_fp16', False):
                         if 'amp' in checkpoint:
                             amp.load_state_dict(checkpoint['amp'])
 
@@ -773,11 +881,17 @@ class XETrainer(BaseTrainer):
 
         self.start_time = time.time()
 
+        # built once so that the data loading workers stay alive between epochs
+        data_iterator = generate_data_iterator(self.train_data, seed=opt.seed, num_workers=opt.num_workers,
+                                               epoch=start_epoch, buffer_size=opt.buffer_size,
+                                               persistent_workers=True)
+
         for epoch in range(start_epoch, start_epoch + opt.epochs):
             print('')
 
             #  (1) train for one epoch on the training set
-            train_loss = self.train_epoch(epoch, resume=resume, itr_progress=itr_progress)
+            train_loss = self.train_epoch(epoch, resume=resume, itr_progress=itr_progress,
+                                          data_iterator=data_iterator)
             train_ppl = math.exp(min(train_loss, 100))
             print('Train perplexity: %g' % train_ppl)
 
@@ -790,4 +904,4 @@ class XETrainer(BaseTrainer):
             itr_progress = None
             resume = False
 
-
+        self.wait_for_save()
@@ -1,4 +1,5 @@
 import logging, traceback
+import inspect
 import os, re
 import torch
 
@@ -47,17 +48,110 @@ def checkpoint_paths(path, pattern=r'model_ppl_(\d+).(\d+)\_e(\d+).(\d+).pt'):
     return [os.path.join(path, x[1]) for x in entries]
 
 
+def copy_to_cpu(obj):
+    """
+    Copy every tensor in a (nested) state dict to the CPU, so that the copy can be written
+    while training continues. The device to host copies are queued without blocking:
+    the caller has to synchronize before using the result
+    """
+    if isinstance(obj, torch.Tensor):
+        if obj.is_cuda:
+            return obj.detach().to('cpu', non_blocking=True)
+        return obj.detach().clone()
+
+    if isinstance(obj, dict):
+        copied = type(obj)((k, copy_to_cpu(v)) for k, v in obj.items())
+        # module state dicts keep their version information here
+        if hasattr(obj, '_metadata'):
+            copied._metadata = obj._metadata
+        return copied
+
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(copy_to_cpu(v) for v in obj)
+
+    return obj
+
+
+def load_checkpoint_mmap(checkpoint_file):
+    """
+    Load a checkpoint on the CPU with its tensors memory-mapped from the file,
+    so that only the storages which are actually used are read (PyTorch >= 2.1).
+    Older PyTorch versions and legacy (non-zip) checkpoints are read completely
+    """
+    try:
+        # the checkpoints also contain the options and dictionaries, so they are not weights only
+        return torch.load(checkpoint_file, map_location='cpu', mmap=True, weights_only=False)
+    except (TypeError, RuntimeError):
+        return torch.load(checkpoint_file, map_location=lambda storage, loc: storage)
+
+
+def assign_state_dict(module, state_dict):
+    """
+    Load a state dict by taking over its tensors instead of copying them into the module (PyTorch >= 2.1)
+    """
+    if 'assign' in inspect.signature(module.load_state_dict).parameters:
+        return module.load_state_dict(state_dict, assign=True)
+
+    return module.load_state_dict(state_dict)
+
+
+def _div_grads(grads, denom):
+    if denom == 1.0 or len(grads) == 0:
+        return
+
+    # the multi-tensor kernels do not handle sparse gradients (sparse embeddings)
+    if hasattr(torch, '_foreach_div_') and not any(g.is_sparse for g in grads):
+        torch._foreach_div_(grads, float(denom))
+    else:
+        for g in grads:
+            g.div_(denom)
+
+
 def normalize_gradients(parameters, denom=1.0):
     if isinstance(parameters, torch.Tensor):
         parameters = [parameters]
-    parameters = list(filter(lambda p: p.grad is not None, parameters))
 
-    for p in parameters:
-        p.grad.data.div_(denom)
+    _div_grads([p.grad for p in parameters if p.grad is not None], denom)
 
     return
 
 
+def normalize_and_clip_gradients(parameters, denom=1.0, max_norm=0.0):
+    """
+    Divide the gradients by denom and clip their total norm to max_norm (if max_norm > 0).
+    Both are done with one multi-tensor norm and one multi-tensor multiplication over all gradients,
+    the clipping coefficient stays on the device (no synchronization).
+    :return: the total norm of the normalized gradients before clipping (None if max_norm <= 0)
+    """
+    if isinstance(parameters, torch.Tensor):
+        parameters = [parameters]
+    parameters = [p for p in parameters if p.grad is not None]
+    grads = [p.grad for p in parameters]
+
+    if max_norm <= 0 or len(grads) == 0:
+        _div_grads(grads, denom)
+        return None
+
+    if not hasattr(torch, '_foreach_norm') or any(g.is_sparse for g in grads):
+        _div_grads(grads, denom)
+        return torch.nn.utils.clip_grad_norm_(parameters, max_norm)
+
+    norms = torch._foreach_norm(grads, 2)
+    total_norm = torch.norm(torch.stack(norms).float(), 2) / denom
+
+    # the same coefficient as clip_grad_norm_, divided by denom
+    scale = torch.clamp(max_norm / (total_norm + 1e-6), max=1.0) / denom
+
+    try:
+        torch._foreach_mul_(grads, scale)
+    except (TypeError, RuntimeError):
+        # older versions only accept python scalars here
+        for g in grads:
+            g.mul_(scale)
+
+    return total_norm
+
+
 # flip a tensor on certain dimension
 def flip(x, dim=0):
     dim = x.dim() + dim if dim < 0 else dim
@@ -77,3 +171,53 @@ def expected_length(length, death_rate):
         e_length += survival_rate
 
     return e_length
+
+
+
+def _storage_numel(tensor):
+    if hasattr(tensor, 'untyped_storage'):
+        return tensor.untyped_storage().nbytes() // tensor.element_size()
+    return tensor.storage().size()
+
+
+def _contiguous_stride(size):
+    stride = [1] * len(size)
+    for i in range(len(size) - 2, -1, -1):
+        stride[i] = stride[i + 1] * size[i + 1]
+    return tuple(stride)
+
+
+# append new (time first) states to an incremental decoding cache
+# room for the following steps is reserved in the storage, so that most steps write in place
+# instead of copying the whole cache into a new tensor (only without autograd)
+def append_to_cache(cached, new, min_capacity=16):
+    if torch.is_grad_enabled() or cached.dtype != new.dtype or cached.device != new.device:
+        return torch.cat([cached, new], dim=0)
+
+    old_length = cached.size(0)
+    size = (old_length + new.size(0),) + tuple(cached.size()[1:])
+    stride = _contiguous_stride(size)
+
+    # the cache has to be laid out exactly like the front of a bigger buffer
+    if cached.storage_offset() == 0 and cached.stride() == stride[:cached.dim()] and \
+            _storage_numel(cached) >= size[0] * stride[0]:
+        grown = cached.as_strided(size, stride)
+    else:
+        capacity = max(2 * size[0], min_capacity)
+        grown = cached.new_empty((capacity,) + size[1:])[:size[0]]
+        grown[:old_length].copy_(cached)
+
+    grown[old_length:].copy_(new)
+    return grown
+
+
+# reorder an incremental decoding cache (time first) along the batch dimension
+# the result is written into a buffer with room for one more step, so that the next append_to_cache
+# does not have to copy the cache again
+def reorder_cache(cached, index):
+    if torch.is_grad_enabled():
+        return cached.index_select(1, index)
+
+    size = (cached.size(0), index.numel()) + tuple(cached.size()[2:])
+    reordered = cached.new_empty((size[0] + 1,) + size[1:])[:size[0]]
+    return torch.index_select(cached, 1, index, out=reordered)
@@ -95,7 +95,9 @@ def make_parser(parser):
     parser.add_argument('-n_heads', type=int, default=8,
                         help='Number of heads for multi-head attention')
     parser.add_argument('-checkpointing', type=int, default=0,
-                        help='Number of checkpointed layers in the Transformer')
+                        help='Enable activation checkpointing in the Transformer when > 0. '
+                             'The layers are checkpointed in about sqrt(L) segments; '
+                             'the value itself is otherwise ignored.')
     parser.add_argument('-attn_dropout', type=float, default=0.1,
                         help='Dropout probability; applied on multi-head attention.')
     parser.add_argument('-emb_dropout', type=float, default=0.1,
@@ -115,6 +117,12 @@ def make_parser(parser):
                         help='Deprecated.')
     parser.add_argument('-residual_type', default='regular',
                         help='Type of residual type. regular|gated')
+    parser.add_argument('-varlen_attention', action='store_true',
+                        help='Remove the padding in the encoder and use the variable length flash attention '
+                             'kernel for self-attention (requires flash_attn and fp16/bf16)')
+    parser.add_argument('-torch_compile', action='store_true',
+                        help='Compile the encoder and decoder layers and the cross entropy loss with torch.compile '
+                             '(requires PyTorch 2.0+)')
     parser.add_argument('-adaptive', type=str, default='shared',
                         help='Universal adaptive layer. universal=UniversalTF|shared=factorized|unshared')
     # Optimization options
@@ -215,6 +223,9 @@ def make_parser(parser):
                         help='Set the model into the experimental mode (trying unverified features)')
     parser.add_argument('-join_embedding', action='store_true',
                         help='Jointly train the embedding of encoder and decoder in one weight')
+    parser.add_argument('-sparse_embedding', action='store_true',
+                        help='Use sparse gradients for large word embeddings. '
+                             'Only used with sgd, without weight_decay, fp16 and tie_weights')
     parser.add_argument('-add_position_encoding', action='store_true',
                         help='Adding pos encodings to embedding (like Transformer)')
     parser.add_argument('-batch_ensemble', type=int, default=0,
@@ -227,6 +238,13 @@ def make_parser(parser):
                         help='Use half precision training')
     parser.add_argument('-fp16_mixed', action='store_true',
                         help='Use mixed half precision training. fp16 must be enabled.')
+    parser.add_argument('-memory_efficient_fp16', action='store_true',
+                        help='Pure half precision training without the fp32 master copy of the weights. '
+                             'The optimizer states are also kept in fp16. '
+                             'Saves memory but is less numerically stable. fp16 must be enabled.')
+    parser.add_argument('-bf16', action='store_true',
+                        help='Run the Transformer forward pass with bfloat16 autocast (Ampere or newer GPUs). '
+                             'Does not need loss scaling and cannot be combined with fp16.')
     parser.add_argument('-seed', default=-1, type=int,
                         help="Seed for deterministic runs.")
 
@@ -356,6 +374,21 @@ def backward_compatible(opt):
     if not hasattr(opt, 'residual_type'):
         opt.residual_type = 'regular'
 
+    if not hasattr(opt, 'checkpointing'):
+        opt.checkpointing = 0
+
+    if not hasattr(opt, 'torch_compile'):
+        opt.torch_compile = False
+
+    if not hasattr(opt, 'bf16'):
+        opt.bf16 = False
+
+    if not hasattr(opt, 'memory_efficient_fp16'):
+        opt.memory_efficient_fp16 = False
+
+    if not hasattr(opt, 'varlen_attention'):
+        opt.varlen_attention = False
+
     if not hasattr(opt, 'input_size'):
         opt.input_size = 40
 
@@ -518,4 +551,7 @@ def backward_compatible(opt):
     if not hasattr(opt, 'weight_drop'):
         opt.weight_drop = 0.0
 
+    if not hasattr(opt, 'sparse_embedding'):
+        opt.sparse_embedding = False
+
     return opt
@@ -39,6 +39,14 @@ if opt.checkpointing > 0:
 if torch.cuda.is_available() and not opt.gpus:
     print("WARNING: You have a CUDA device, should run with -gpus 0")
 
+if opt.bf16 and opt.fp16:
+    print("WARNING: bf16 cannot be combined with fp16. Using fp16.")
+    opt.bf16 = False
+
+if opt.memory_efficient_fp16 and (not opt.fp16 or opt.fp16_mixed):
+    print("WARNING: memory_efficient_fp16 requires fp16 without fp16_mixed. Disabling memory_efficient_fp16.")
+    opt.memory_efficient_fp16 = False
+
 torch.manual_seed(opt.seed)
 
 